@@ -3,37 +3,44 @@ from train import *
 
 class JointTraining(Trainer):
 
-    def __init__(self, data_loader_train_1: DataLoader, data_loader_val_1: DataLoader, model: GeneralModel,
+    """
+    trains a combined model on the loaders of a LyricsPairedDataset, which yield aligned
+    ((embeddings, targets, lengths), (sentences, sentence targets, sentence lengths)) batches
+    """
+
+    # the parts of a combined model that a combination method does not use get no gradients
+    _find_unused_parameters = True
+
+    def __init__(self, data_loader_train: DataLoader, data_loader_validation: DataLoader, model: GeneralModel,
                  optimizer: Optimizer, loss_function: GeneralModel, args: argparse.Namespace, patience: int,
-                 data_loader_train_2: DataLoader, data_loader_val_2: DataLoader, device="cpu"):
-        super().__init__(data_loader_train_1, data_loader_val_1, model, optimizer, loss_function, args, patience, device=device)
-        self.data_loader_validation_2 = data_loader_val_2
-        self.data_loader_train_2 = data_loader_train_2
+                 device="cpu", data_loader_validation_subset: DataLoader = None):
+        super().__init__(data_loader_train, data_loader_validation, model, optimizer, loss_function, args, patience, device=device,
+                         data_loader_validation_subset=data_loader_validation_subset)
 
     def _epoch_iteration(
             self,
             epoch_num: int,
             best_metrics: Tuple[float, float],
-            patience: int) -> Tuple[List, Tuple, int]:
+            patience: int) -> Tuple[np.ndarray, Tuple, int]:
 
 
-        progress = []
-
-        train_accuracy = 0
-        train_loss = 0
+        self._train_metrics.reset()
         data_loader_length = len(self.data_loader_train)
 
-        for i, items in enumerate(zip(self.data_loader_train, self.data_loader_train_2)):
+        self._real_tokens, self._padded_tokens = 0, 0
+        self._data_stall.reset()
+        self._epoch_start_time = time.time()
+
+        for i, items in enumerate(self._data_stall.wrap(self.data_loader_train)):
             (batch, targets, lengths), (batch2, targets2, lengths2) = items
             print(f'Train: {i}/{data_loader_length}       \r', end='')
 
+            # the pairs are batched (and bucketed) by the lengths of their embedding half
+            self._count_padding(batch, lengths)
+
             # do forward pass and whatnot on batch
             loss_batch, accuracy_batch = self._batch_iteration_joint(batch, targets, lengths, (batch2, targets2, lengths2), i)
-            train_loss += loss_batch
-            train_accuracy += accuracy_batch
-
-            # add to list somehow:
-            progress.append({"loss": loss_batch, "acc": accuracy_batch})
+            self._train_metrics.add(loss=loss_batch, acc=accuracy_batch)
 
             # calculate amount of batches and walltime passed
             time_passed = datetime.now() - DATA_MANAGER.actual_date
@@ -41,23 +48,21 @@ class JointTraining(Trainer):
 
             # run on validation set and print progress to terminal
             # if we have eval_frequency or if we have finished the epoch
-            if (batches_passed % self.arguments.eval_freq) == 0 or (i + 1 == data_loader_length):
-                loss_validation, acc_validation = self._evaluate()
-
-                new_best = False
-                if self.model.compare_metric(best_metrics, loss_validation, acc_validation):
-                    save_models([self.model], 'model_best')
+            for loss_validation, acc_validation, new_best in self._validations(i + 1 == data_loader_length,
+                                                                               batches_passed,
+                                                                               best_metrics):
+                if new_best:
                     best_metrics = (loss_validation, acc_validation)
-                    new_best = True
                     patience = self._patience
                 else:
                     patience -= 1
 
+                train_metrics = self._train_metrics.means()
                 self._log(
                     loss_validation,
                     acc_validation,
-                    (train_loss / (i + 1)),
-                    (train_accuracy / (i + 1)),
+                    train_metrics['loss'],
+                    train_metrics['acc'],
                     batches_passed,
                     float(time_passed.microseconds),
                     epoch_num,
@@ -69,35 +74,38 @@ class JointTraining(Trainer):
                     print("weights lstm:", self.model.W_classifier, "weights vaes:", self.model.W_vaes, "\n\n")
 
             # check if runtime is expired
-            if (time_passed.total_seconds() > (self.arguments.max_training_minutes * 60)) \
-                    and self.arguments.max_training_minutes > 0:
-                raise KeyboardInterrupt(f"Process killed because {self.arguments.max_training_minutes} minutes passed "
-                                        f"since {DATA_MANAGER.actual_date}. Time now is {datetime.now()}")
+            self._check_runtime(time_passed, batches_passed)
 
             if patience == 0:
                 break
 
-        return progress, best_metrics, patience
+        return self._train_metrics.history(), best_metrics, patience
 
-    def _evaluate(self) -> Tuple[float, float]:
+    def _evaluate(self, full: bool = True) -> Tuple[float, float]:
         """
-        runs iteration on validation set
+        runs iteration on validation set (or its subset) without autograd, the batch results stay on the device
+        until the end
         """
 
-        accuracies = []
-        losses = []
-        data_loader_length = len(self.data_loader_validation)
+        data_loader = self._validation_loader(full)
+        data_loader_length = len(data_loader)
+        metrics = MetricAccumulator(['loss', 'acc'], distributed=is_distributed())
 
-        for i, items in enumerate(zip(self.data_loader_validation, self.data_loader_validation_2)):
-            (batch, targets, lengths), (batch2, targets2, lengths2) = items
-            print(f'Validation: {i}/{data_loader_length}       \r', end='')
+        self.model.eval()
+        with inference_mode():
+            for i, items in enumerate(self._data_stall.wrap(data_loader)):
+                (batch, targets, lengths), (batch2, targets2, lengths2) = items
+                if self._show_progress:
+                    print(f'Validation: {i}/{data_loader_length}       \r', end='')
 
-            # do forward pass and whatnot on batch
-            loss_batch, accuracy_batch = self._batch_iteration_joint(batch, targets, lengths, (batch2, targets2, lengths2), i, train_mode=False)
-            accuracies.append(accuracy_batch)
-            losses.append(loss_batch)
+                # do forward pass and whatnot on batch
+                loss_batch, accuracy_batch = self._forward_joint(batch, targets, lengths, (batch2, targets2, lengths2), i)
+                metrics.add(loss=loss_batch, acc=accuracy_batch)
+
+        self._last_evaluation_time = time.time()
 
-        return float(np.mean(losses)), float(np.mean(accuracies))
+        means = metrics.means()
+        return means['loss'], means['acc']
 
 
     def _batch_iteration_joint(self,
@@ -111,33 +119,49 @@ class JointTraining(Trainer):
         runs forward pass on batch and backward pass if in train_mode
         """
 
-        batch2, targets2, lengths2 = sentencebatch
-        batch = batch.to(self._device)
-        targets = targets.to(self._device)
-        lengths = lengths.to(self._device)
-
         if train_mode:
             self.model.train()
-            self.optimizer.zero_grad()
         else:
             self.model.eval()
 
+        # the last batch of the epoch always steps, so no gradients carry over to the next epoch
+        last = step + 1 == len(self.data_loader_train)
+
+        # the gradients are only all-reduced over the processes for the micro-batch before an optimizer step
+        with gradient_sync(self._training_model, sync=not train_mode or self._gradients.will_step(last)):
+            loss, accuracy = self._forward_joint(batch, targets, lengths, sentencebatch, step)
+
+            if train_mode:
+                self._gradients.backward(loss, last=last)
+
+        return loss.detach(), accuracy.detach()
+
+    def _forward_joint(self,
+                       batch: torch.Tensor,
+                       targets: torch.Tensor,
+                       lengths: torch.Tensor,
+                       sentencebatch,
+                       step) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        moves a paired batch to the device and returns its loss and accuracy as (device) tensors
+        """
+
+        batch2, targets2, lengths2 = sentencebatch
+        batch = batch.to(self._device)
+        targets = targets.to(self._device)
+        lengths = lengths.to(self._device)
+
         if batch2 is not None:
             batch2 = batch2.to(self._device)
             targets2 = targets2.to(self._device)
             lengths2 = lengths2.to(self._device)
 
-        output, (_, _) = self.model.forward(batch, targets, lengths, (batch2, targets2, lengths2), step)
+        model = self._training_model if self.model.training else self.model
 
-        loss = self.loss_function(targets, output)
-        accuracy = calculate_accuracy(targets, output)
+        with autocast(self._device, self.arguments.autocast_dtype):
+            output, (_, _) = model.forward(batch, targets, lengths, (batch2, targets2, lengths2), step)
+            loss = self.loss_function(targets, output)
 
-        if train_mode:
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=5.0)
-            self.optimizer.step()
-
-        loss = loss.item()
-        accuracy = accuracy.item()
+        accuracy = calculate_accuracy(targets, output)
 
         return loss, accuracy
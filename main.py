@@ -10,7 +10,7 @@ except:
 
 import argparse
 import sys
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 
 from models.enums.Genre import Genre
 from models.datasets.BaseDataset import BaseDataset
@@ -20,49 +20,55 @@ from analyzer import Analyzer
 from utils.constants import *
 from utils.model_utils import find_right_model
 from utils.system_utils import ensure_current_directory
-from utils.dataloader_utils import pad_and_sort_batch
+from utils.dataloader_utils import PaddedBatchCollator, get_loader_settings
+from utils.samplers import BucketBatchSampler, TokenBudgetBatchSampler, StratifiedSubsetSampler, DistributedBatchSampler
+from utils.distributed_utils import is_distributed, get_rank, get_world_size, get_local_rank, launch, launch_world_size
 import numpy as np
 import random
 
 
 def main(arguments: argparse.Namespace):
     """ where the magic happens """
-    device = args.device
-    if args.device == None:
+    device = arguments.device
+    if arguments.device == None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
     # for reproducibility
-    torch.manual_seed(args.seed)
-    np.random.seed(args.seed)
-    random.seed(args.seed)
+    torch.manual_seed(arguments.seed)
+    np.random.seed(arguments.seed)
+    random.seed(arguments.seed)
 
     if device == 'cuda':
         torch.backends.cudnn.benchmark = False
-        torch.cuda.manual_seed_all(args.seed)
+        torch.cuda.manual_seed_all(arguments.seed)
+
+        if is_distributed():
+            # one gpu per process of a node
+            device = f'cuda:{get_local_rank()}'
+            torch.cuda.set_device(device)
 
     data_loader_train: DataLoader = None
     data_loader_validation: DataLoader = None
+    data_loader_validation_subset: DataLoader = None
     data_loader_test: DataLoader = None
 
     if arguments.joint_training:
-        data_loader_train_ = load_dataloader(arguments, TRAIN_SET)
-        data_loader_validation_ = load_dataloader(arguments, VALIDATION_SET)
-        arguments.dataset_class = arguments.dataset_class_sentencevae
-        data_loader_sentenceVAE = load_dataloader(arguments, TRAIN_SET)
-        data_loader_sentenceVAE_validation = load_dataloader(arguments, VALIDATION_SET)
+        # one loader of aligned (embeddings, sentence) records for the classifier and the VAEs
+        data_loader_train = load_dataloader(arguments, TRAIN_SET, paired=True)
+        data_loader_validation = load_dataloader(arguments, VALIDATION_SET, paired=True)
 
     elif arguments.test_mode:
         # we are in test mode
-        data_loader_test = load_dataloader(arguments, TEST_SET)
-        data_loader_sentenceVAE = None
-        if arguments.dataset_class_sentencevae:
-            arguments.dataset_class = arguments.dataset_class_sentencevae
-            data_loader_sentenceVAE = load_dataloader(arguments, TEST_SET)
+        data_loader_test = load_dataloader(arguments, TEST_SET, paired=bool(arguments.dataset_class_sentencevae))
     else:
         # load needed data
         data_loader_train = load_dataloader(arguments, TRAIN_SET)
         data_loader_validation = load_dataloader(arguments, VALIDATION_SET)
 
+    if data_loader_validation is not None and arguments.eval_subset > 0:
+        # frequent validation checks run on a subset, the full validation set is only used at the end of an epoch
+        data_loader_validation_subset = load_subset_dataloader(arguments, data_loader_validation, arguments.eval_subset)
+
     # get model from models-folder (name of class has to be identical to filename)
     arguments.hidden_dim_vae = arguments.hidden_dim if arguments.hidden_dim_vae == 0 else arguments.hidden_dim_vae
     model = find_right_model(
@@ -82,7 +88,7 @@ def main(arguments: argparse.Namespace):
         classifier_name=arguments.classifier_name,
         hidden_dim_vae=arguments.hidden_dim_vae,
         vaes_names=arguments.vaes_names,
-        dataset_options=data_loader_sentenceVAE.dataset if data_loader_train is None else data_loader_train.dataset,
+        dataset_options=data_loader_test.dataset if data_loader_train is None else data_loader_train.dataset,
         combination_method=arguments.combination,
         generator_loss="VAELoss" if arguments.joint_training else arguments.loss,
         generator_class=arguments.generator,
@@ -97,7 +103,7 @@ def main(arguments: argparse.Namespace):
     if arguments.test_mode:
         test_logs = None
         if not arguments.skip_test:
-            tester = Tester(model, data_loader_test, device=device, data_loader_sentence=data_loader_sentenceVAE)
+            tester = Tester(model, data_loader_test, device=device)
             test_logs = tester.test()
 
         if arguments.analysis:
@@ -109,18 +115,17 @@ def main(arguments: argparse.Namespace):
         optimizer = find_right_model(OPTIMS, arguments.optimizer, params=model.parameters(), lr=arguments.learning_rate)
 
         if arguments.joint_training:
-            loss_function = find_right_model(LOSS_DIR, arguments.loss, dataset_options=data_loader_train_.dataset,
+            loss_function = find_right_model(LOSS_DIR, arguments.loss, dataset_options=data_loader_train.dataset,
                                              device=device).to(device)
-            JointTraining(data_loader_train_,
-                          data_loader_validation_,
+            JointTraining(data_loader_train,
+                          data_loader_validation,
                           model,
                           optimizer,
                           loss_function,
                           arguments,
-                          args.patience,
-                          data_loader_sentenceVAE,
-                          data_loader_sentenceVAE_validation,
-                          device=device
+                          arguments.patience,
+                          device=device,
+                          data_loader_validation_subset=data_loader_validation_subset
                           ).train()
 
         else:
@@ -135,34 +140,90 @@ def main(arguments: argparse.Namespace):
                 optimizer,
                 loss_function,
                 arguments,
-                args.patience,
-                device)
+                arguments.patience,
+                device,
+                data_loader_validation_subset=data_loader_validation_subset)
             trainer.train()
 
 
 def load_dataloader(arguments: argparse.Namespace,
-                    set_name: str) -> DataLoader:
-    """ loads specific dataset as a DataLoader """
+                    set_name: str,
+                    paired: bool = False) -> DataLoader:
+    """ loads specific dataset as a DataLoader, or the dataset paired with the sentence dataset """
 
     dataset: BaseDataset = find_right_model(DATASETS,
-                                            arguments.dataset_class,
+                                            'LyricsPairedDataset' if paired else arguments.dataset_class,
                                             folder=arguments.data_folder,
                                             set_name=set_name,
                                             genre=Genre.from_str(arguments.genre),
                                             normalize=arguments.normalize_data,
                                             arguments=arguments)
 
-    loader = DataLoader(
-        dataset,
-        shuffle=(set_name is TRAIN_SET),
-        batch_size=arguments.batch_size)
+    batch_sampler = None
+    if not arguments.test_mode:
+        if arguments.max_tokens_per_batch > 0:
+            batch_sampler = TokenBudgetBatchSampler(dataset.get_lengths(),
+                                                    arguments.max_tokens_per_batch,
+                                                    shuffle=(set_name is TRAIN_SET))
+        elif arguments.length_buckets > 0:
+            batch_sampler = BucketBatchSampler(dataset.get_lengths(),
+                                               arguments.batch_size,
+                                               number_of_buckets=arguments.length_buckets,
+                                               shuffle=(set_name is TRAIN_SET))
+
+    sampler = None
+    if is_distributed() and not arguments.test_mode:
+        # every process loads its own shard of the set
+        if batch_sampler is not None:
+            batch_sampler = DistributedBatchSampler(batch_sampler, seed=arguments.seed)
+        else:
+            sampler = DistributedSampler(dataset, shuffle=(set_name is TRAIN_SET), seed=arguments.seed)
+
+    if batch_sampler is not None:
+        loader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            **get_loader_settings(arguments))
+    else:
+        loader = DataLoader(
+            dataset,
+            sampler=sampler,
+            shuffle=(sampler is None and set_name is TRAIN_SET),
+            batch_size=arguments.batch_size,
+            **get_loader_settings(arguments))
 
     if dataset.use_collate_function():
-        loader.collate_fn = pad_and_sort_batch
+        loader.collate_fn = PaddedBatchCollator(dtype=getattr(torch, arguments.collate_dtype),
+                                                pad_value=arguments.pad_value,
+                                                number_of_buffers=arguments.collate_buffers)
+    elif dataset.collate_function() is not None:
+        loader.collate_fn = dataset.collate_function()
 
     return loader
 
 
+def load_subset_dataloader(arguments: argparse.Namespace,
+                           loader: DataLoader,
+                           number_of_items: int) -> DataLoader:
+    """ loads a fixed subset of the dataset of a loader, stratified by class if the dataset has labels """
+
+    dataset: BaseDataset = loader.dataset
+    try:
+        labels = dataset.get_labels()
+    except NotImplementedError:
+        labels = np.zeros(len(dataset), dtype=np.int64)
+
+    subset_loader = DataLoader(
+        dataset,
+        sampler=StratifiedSubsetSampler(labels, number_of_items, seed=arguments.seed,
+                                        num_replicas=get_world_size(), rank=get_rank()),
+        batch_size=arguments.batch_size,
+        **get_loader_settings(arguments))
+    subset_loader.collate_fn = loader.collate_fn
+
+    return subset_loader
+
+
 def parse() -> argparse.Namespace:
     """ does argument parsing """
 
@@ -170,7 +231,13 @@ def parse() -> argparse.Namespace:
 
     # int
     parser.add_argument('--epochs', default=500, type=int, help='max number of epochs')
-    parser.add_argument('--eval_freq', default=10, type=int, help='evaluate every x batches')
+    parser.add_argument('--eval_freq', default=10, type=int, help='evaluate every x batches (0 is off)')
+    parser.add_argument('--eval_seconds', default=0, type=int, help='evaluate every x seconds of training (0 is off)')
+    parser.add_argument('--accumulation_steps', default=1, type=int,
+                        help='sum the gradients of x batches before every optimizer step')
+    parser.add_argument('--eval_threads', default=1, type=int, help='cpu threads of the --async_eval evaluator')
+    parser.add_argument('--eval_subset', default=0, type=int,
+                        help='evaluate on a stratified subset of x items, the full set only at epoch end (0 is off)')
     parser.add_argument('--saving_freq', default=1, type=int, help='save every x epochs')
     parser.add_argument('--batch_size', default=64, type=int, help='size of batches')
     parser.add_argument('--embedding_size', default=256, type=int, help='size of embeddings')  # todo
@@ -179,9 +246,32 @@ def parse() -> argparse.Namespace:
     parser.add_argument('--z_dim', default=32, type=int, help='size of batches')
     parser.add_argument('--max_training_minutes', default=24 * 60, type=int,
                         help='max mins of training be4 save-and-kill')
+    parser.add_argument('--num_workers', default=0, type=int, help='number of DataLoader worker processes')
+    parser.add_argument('--tokenize_processes', default=0, type=int,
+                        help='number of processes that tokenize the lyrics of the LyricsRawDataset, 0 for all cores')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='batches loaded in advance per worker')
+    parser.add_argument('--max_tokens_per_batch', default=0, type=int,
+                        help='fill batches up to x padded lines/words instead of --batch_size songs (0 is off)')
+    parser.add_argument('--length_buckets', default=0, type=int,
+                        help='draw every batch from one of x buckets of similar song lengths (0 is off)')
+    parser.add_argument('--song_cache_mb', default=0, type=int,
+                        help='megabytes of decoded songs to cache per process (0 is off)')
+    parser.add_argument('--bow_hash_features', default=0, type=int,
+                        help='hash the words of the BOWDataloader into this many features, 0 uses a vocabulary')
+    parser.add_argument('--collate_buffers', default=0, type=int,
+                        help='pad batches into a pool of x reused buffers (0 allocates every batch)')
+    parser.add_argument('--memory_report_freq', default=0, type=int,
+                        help='report resident memory every x items per worker (0 is off)')
+    parser.add_argument('--processes_per_node', default=1, type=int,
+                        help='number of data-parallel training processes on this node')
+    parser.add_argument('--nodes', default=1, type=int, help='number of nodes of data-parallel training')
+    parser.add_argument('--node_rank', default=0, type=int, help='index of this node among the --nodes')
+    parser.add_argument('--master_port', default=29500, type=int,
+                        help='port of the first node for data-parallel training')
 
     # float
     parser.add_argument('--learning_rate', default=1e-3, type=float, help='learning rate')
+    parser.add_argument('--pad_value', default=0.0, type=float, help='value of padded positions in batches')
 
     # string
     parser.add_argument('--classifier', default="LSTMClassifier", type=str, help='classifier model name')
@@ -192,6 +282,16 @@ def parse() -> argparse.Namespace:
     parser.add_argument('--dataset_class', default="LyricsDataset", type=str, help='dataset name')
     parser.add_argument('--dataset_class_sentencevae', default=None, type=str, help='dataset for'
                                                                                     ' sentence vae')
+    parser.add_argument('--collate_dtype', default="float32", type=str, help='dtype of padded batches')
+    parser.add_argument('--autocast_dtype', default="float32", type=str,
+                        help='float32/bfloat16/float16, autocast precision of the forward pass (float16 needs cuda)')
+    parser.add_argument('--embedding_backend', default="hdf5", type=str,
+                        help='hdf5/mmap, embeddings storage of the LyricsPacked datasets')
+    parser.add_argument('--embedding_encoding', default="float32", type=str,
+                        help='float32/float16/int8, storage encoding of the LyricsPacked datasets')
+    parser.add_argument('--bow_file', default="", type=str, help='csv file of the BOWDataloader, song lyrics if empty')
+    parser.add_argument('--master_addr', default="localhost", type=str,
+                        help='address of the first node for data-parallel training')
 
     parser.add_argument('--run_name', default="", type=str, help='extra identification for run')
     parser.add_argument('--genre', type=str, default=None,
@@ -205,6 +305,12 @@ def parse() -> argparse.Namespace:
     parser.add_argument('--normalize_data', action='store_true', help='normalize data')
     parser.add_argument('--combined_classification', action='store_true', help='combined classification')
     parser.add_argument('--skip_test', action='store_true', help='directly analyze data')
+    parser.add_argument('--persistent_workers', action='store_true', help='keep DataLoader workers between epochs')
+    parser.add_argument('--sort_token_batches', action='store_true', help='sort LyricsRawDataset batches by length')
+    parser.add_argument('--bow_sparse', action='store_true', help='keep BOWDataloader batches as sparse tensors')
+    parser.add_argument('--async_eval', action='store_true', help='validate weight snapshots in a background process')
+    parser.add_argument('--embedding_dedup', action='store_true',
+                        help='store every distinct lyric line once in the LyricsPacked datasets')
 
     parser.add_argument("--device", type=str,
                         help="Device to be used. Pick from none/cpu/cuda. "
@@ -237,4 +343,8 @@ if __name__ == '__main__':
     ensure_current_directory()
     args = parse()
     print(args)
-    main(args)
+    if launch_world_size(args) > 1 and not args.test_mode:
+        # data-parallel training, main runs in processes_per_node processes that each train on a shard of the data
+        launch(main, args)
+    else:
+        main(args)
@@ -1,133 +1,110 @@
-from torch.utils.data import DataLoader
-from torch.utils.data import Dataset
+import os
+
 import numpy as np
 import pandas as pd
-import torch
-from collections import Counter
-import nltk
-nltk.download('punkt')
 
-class BOWDataloader(Dataset):
+from models.datasets.BaseDataset import BaseDataset
+from utils.bow_utils import build_bow_matrix
+from utils.constants import *
+from utils.data_manager import DataManager
+from utils.dataloader_utils import SparseBatchCollator
+from utils.song_metadata import load_song_metadata
 
-    def __init__(self, file="", set_name="train", **kwargs):
-        super(BOWDataloader, self).__init__()
 
-        df = pd.read_csv('/Users/bellanicholson/Desktop/DL4NLP/code/DL4NLP/local_data/data/spam_dataset.csv')
-        # todo: remove [:80], just done for testing purposes
-        raw_data = np.array(df.Message)[:80]
-        labels = np.array(df.Category)[:80]
-
-        # convert string labels into int labels
-        self.labels = self.rewrite_labels(labels)
-
-        # tokenize all word in raw data
-        words_list = self.tokenize_words(raw_data)
-        # all the unique words in the data set
-        unique_words = set(words_list)
-
-        vocabulary = self.create_vocab(unique_words)
-        vocabulary, self.normalizing_vec = self.calc_word_freq(words_list, vocabulary)
-        self.encoded_data = self.encode_data(raw_data, vocabulary)
-
-        # converting things into tensors
-        self.labels = torch.from_numpy(self.labels)
-        self.encoded_data = torch.from_numpy(self.encoded_data)
-        self.normalizing_vec = torch.from_numpy(self.normalizing_vec)
-
-
-    def tokenize_words(self, raw_text):
-
-        processed_text = []
-        # tokenizing words by line
-        for line in raw_text:
-            processed_line = nltk.word_tokenize(line.lower())
-            processed_text.extend(processed_line)
-        return processed_text
-
-    def rewrite_labels(self, labels):
-        """
-        Rewrites each label class as a number.
-
-        :param labels: The list of labels as type=str (w.r.t. entire dataset).
-        :return: The list of labels as type=int.
-        """
-
-        new_labels = []
-
-        # Answers: "Is this spam?"
-        for label in labels:
-            if label == "spam":
-                new_labels.append(1)
-            if label == "ham":
-                new_labels.append(0)
-
-        new_labels = np.asarray(new_labels)
-        return new_labels
-
-
-    # edited so it words with words and not chars
-    def create_vocab(self, data):
-        # function goes through all data, and returns dict of unique_char:charID
-        # will be used later to make one-hot vec encodings
-        # flattened = [d for sublist in data for d in sublist]
-        unique_chars_list = sorted(data)
-        vocabulary = dict((c, i) for i, c in enumerate(unique_chars_list))
-        return vocabulary
-
-    def calc_word_freq(self, dataset, vocabulary):
-        """
-        Calculate word frequency in our dataset.
-
-        :param dataset: Appends word_count to vocab
-        :param vocabulary: {"word": wordID}
-        :return: vocabulary --> {"word": [wordID, word_count]}
-        """
-        normalizing_vec = []
-        word_counts = Counter(dataset)
-        for word in vocabulary.keys():
-            word_ID = vocabulary[word]
-            vocabulary[word] = [word_ID, word_counts[word]]
-            normalizing_vec.append(word_counts[word])
-        return vocabulary, np.asarray(normalizing_vec)
-
-
-    # TODO: check this function
-    def encode_data(self, raw_data, vocabulary):
-        """
-        Uses vocabulary to build a one hot vec to correspond to each word. Appends
-
-        :param words_list: Unprocessed dataset
-        :param vocabulary: {"word": word_ID, word_freq}
-        :return: vocabulary as
-        """
-        # encode by line
-        encoded_data = []
-        # loop through text line by line
-        for line in raw_data:
-            # print('LINE', line)
-            # processing text
-            words = nltk.word_tokenize(line.lower())
-            # creating empty tensor that will show word counts of all words in that particular line
-            encoded_line = [0 for _ in range(len(vocabulary.keys()))]
-            for word in words:
-                wordID, word_freq = vocabulary[word]
-                encoded_line[wordID] = word_freq
-            encoded_data.append(encoded_line)
-        encoded_data = np.stack(encoded_data, axis=0)
-        return encoded_data
+class BOWDataloader(BaseDataset):
+    """
+    bag-of-words dataset, keeps the word counts of every text as one CSR matrix.
+
+    texts are read from a csv file (text and label column) if one is given, where {set} in the file name is replaced
+    by the set name, otherwise from the lyrics and genres of the song metadata of the set. the vocabulary is built on
+    the train set and saved as bow.vocab.pickle (bow.vocab.{train csv name}.pickle for csv files), so all sets share
+    the same columns. with hash_features > 0 the words are hashed into that many columns and no vocabulary is kept
+    """
 
+    def __init__(self, folder, set_name="train", file=None, text_column='Message', label_column='Category',
+                 hash_features=None, **kwargs):
+        super(BOWDataloader, self).__init__()
+
+        arguments = kwargs.get('arguments', None)
+        file = file or getattr(arguments, 'bow_file', '')
+        self.hash_features = hash_features or getattr(arguments, 'bow_hash_features', 0)
+        self.dense = not getattr(arguments, 'bow_sparse', False)
+        # 0 tokenizes on all cores
+        processes = getattr(arguments, 'tokenize_processes', 0) or None
+
+        if file:
+            train_file = file.format(set=TRAIN_SET)
+            texts, label_strings = self._read_csv(file.format(set=set_name), text_column, label_column)
+            # string labels become their index in the sorted label names of the train set, e.g. ham: 0, spam: 1
+            label_names = np.unique(self._read_csv(train_file, text_column, label_column)[1])
+            labels = np.searchsorted(label_names, label_strings)
+            assert np.all(label_names[np.minimum(labels, len(label_names) - 1)] == label_strings), \
+                f'{set_name} has labels that are not in {train_file}'
+            vocabulary_name = f'bow.vocab.{os.path.splitext(os.path.basename(train_file))[0]}'
+            train_texts = lambda: self._read_csv(train_file, text_column, label_column)[0]
+        else:
+            songs = load_song_metadata(folder, set_name)
+            texts = songs.all_lyrics()
+            labels = songs.genre
+            vocabulary_name = 'bow.vocab'
+            train_texts = lambda: load_song_metadata(folder, TRAIN_SET).all_lyrics()
+
+        vocabulary, grow_vocabulary = self._load_vocabulary(folder, set_name, vocabulary_name, train_texts, processes)
+
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.indptr, self.indices, self.counts, self.lengths = build_bow_matrix(texts,
+                                                                                vocabulary,
+                                                                                grow_vocabulary,
+                                                                                self.hash_features,
+                                                                                processes)
+        self.vocabulary = None if self.hash_features > 0 else vocabulary
+        self.number_of_features = self.hash_features if self.hash_features > 0 else len(vocabulary)
+
+        if grow_vocabulary:
+            DataManager(folder).save_python_obj(vocabulary, vocabulary_name)
+
+        # how often every word occurs in the whole set
+        self.normalizing_vec = np.bincount(self.indices, weights=self.counts, minlength=self.number_of_features)
+
+        print('-- Loaded dataset:', set_name, '- size:', self.__len__(), '- features:', self.number_of_features)
+
+    @staticmethod
+    def _read_csv(file, text_column, label_column):
+        """ returns the texts and the (string) labels of a csv file """
+
+        data_frame = pd.read_csv(file, usecols=[text_column, label_column]).dropna()
+        return data_frame[text_column].astype(str).tolist(), data_frame[label_column].astype(str).values
+
+    def _load_vocabulary(self, folder, set_name, vocabulary_name, train_texts, processes):
+        """ returns the train vocabulary and whether it still has to be built from this set """
+
+        if self.hash_features > 0:
+            return {}, False
+        if os.path.exists(os.path.join(folder, f'{vocabulary_name}.pickle')):
+            return DataManager(folder).load_python_obj(vocabulary_name), False
+        if set_name == TRAIN_SET:
+            return {}, True
+
+        vocabulary = {}
+        build_bow_matrix(train_texts(), vocabulary, True, 0, processes)
+        DataManager(folder).save_python_obj(vocabulary, vocabulary_name)
+        return vocabulary, False
 
     def __len__(self):
-        return self.encoded_data.shape[0]
+        return len(self.labels)
 
     def __getitem__(self, item):
-        # item im hoping is an integer to index
-        return self.encoded_data[item, :], self.labels[item].long()
-        # return self.encoded_data[item, :] / self.norm_vec, self.labels[item].long()
+        start, end = self.indptr[item], self.indptr[item + 1]
+        return self.indices[start:end], self.counts[start:end], self.labels[item], self.lengths[item]
+
+    def get_lengths(self) -> np.ndarray:
+        return self.lengths
 
-# # Dummy test
-# x = DataLoader(CheckDataLoader())
-# for i, tens in enumerate(x):
-#     print(i)
+    def get_labels(self) -> np.ndarray:
+        return self.labels
 
+    def use_collate_function(self) -> bool:
+        return False
 
+    def collate_function(self):
+        return SparseBatchCollator(self.number_of_features, dense=self.dense)
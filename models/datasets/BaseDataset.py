@@ -1,3 +1,4 @@
+import numpy as np
 from torch.utils.data import Dataset
 
 class BaseDataset(Dataset):
@@ -5,4 +6,24 @@ class BaseDataset(Dataset):
         super(BaseDataset, self).__init__()
 
     def use_collate_function(self) -> bool:
-        return False
\ No newline at end of file
+        return False
+
+    def yields_pairs(self) -> bool:
+        """ whether the batches are ((embeddings, targets, lengths), (sentences, targets, lengths)) pairs """
+        return False
+
+    def collate_function(self):
+        """ returns the collate function of datasets that don't use the padded embeddings collate, if any """
+        return None
+
+    def get_lengths(self) -> np.ndarray:
+        """ returns the sequence length of every item, used to batch items of similar lengths """
+        raise NotImplementedError(f'{self.__class__.__name__} has no lengths')
+
+    def get_song_ids(self) -> np.ndarray:
+        """ returns the start index of every item's song in its set, which identifies the song across datasets """
+        raise NotImplementedError(f'{self.__class__.__name__} has no song ids')
+
+    def get_labels(self) -> np.ndarray:
+        """ returns the class of every item without loading the items, used to subsample items per class """
+        raise NotImplementedError(f'{self.__class__.__name__} has no labels')
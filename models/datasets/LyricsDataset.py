@@ -1,11 +1,14 @@
 import os
 
-import h5py
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+from utils.cache_utils import SongTensorCache
 from utils.data_manager import DataManager
+from utils.embedding_utils import embeddings_file_path, load_missing_lines, songs_without_missing_lines
+from utils.hdf5_utils import get_hdf5_file
+from utils.song_metadata import SongMetadata, load_song_metadata
 
 from models.datasets.BaseDataset import BaseDataset
 
@@ -16,18 +19,22 @@ class LyricsDataset(BaseDataset):
 
         self.normalize = normalize
 
+        # optional in-memory LRU cache of the decoded songs, so passes over data that fits in RAM skip the disk
+        arguments = kwargs.get('arguments', None)
+        cache_megabytes = getattr(arguments, 'song_cache_mb', 0)
+        self.cache = SongTensorCache(cache_megabytes * 2 ** 20) if cache_megabytes > 0 and self._decodes_copies() \
+            else None
+
         data_manager = DataManager(folder)
 
-        # load the song entries pickle
-        self._song_entries = self.setup(data_manager, set_name)
+        # load the columnar song metadata
+        self._songs = self.setup(data_manager, set_name)
         self.set_name = set_name
         # assert that the embedding folder exists inside the passed folder
         embeddings_folder_path = os.path.join(folder, 'embeddings')
         assert os.path.exists(embeddings_folder_path)
 
-        # assert that the embedding file for this set exists inside the embedding folder
-        self._embeddings_file_path = os.path.join(embeddings_folder_path, f'embeddings.{set_name}.hdf5')
-        assert os.path.exists(self._embeddings_file_path)
+        self._setup_embeddings(folder, set_name)
 
         print('-- Loaded dataset:', self.set_name, '- size:', self.__len__())
 
@@ -41,38 +48,70 @@ class LyricsDataset(BaseDataset):
         self.__getitem__(4)
         self.__getitem__(5)
 
-    def setup(self, data_manager: DataManager, set_name: str):
-        return data_manager.load_python_obj(f'song_lyrics.{set_name}')
+    def _setup_embeddings(self, folder, set_name):
+        # assert that the embedding file for this set exists inside the embedding folder
+        self._embeddings_file_path = embeddings_file_path(folder, set_name)
+        assert os.path.exists(self._embeddings_file_path)
+
+        total_lines = int(np.max(self._songs.start_index + self._songs.number_of_lines, initial=0))
+        self._drop_songs_with_missing_lines(load_missing_lines(self._embeddings_file_path, total_lines))
+
+    def _drop_songs_with_missing_lines(self, missing_lines: np.ndarray):
+        """ leaves out the songs that miss embeddings once, so only valid songs are ever read """
+
+        valid = songs_without_missing_lines(self._songs.start_index, self._songs.number_of_lines, missing_lines)
+        if not np.all(valid):
+            print(f'Skipping {int(np.sum(~valid))} songs with missing lines in {self.set_name}')
+            self._songs = self._songs.select(valid)
+
+    def setup(self, data_manager: DataManager, set_name: str) -> SongMetadata:
+        return load_song_metadata(data_manager.directory, set_name)
 
     def __len__(self):
-        return len(self._song_entries)
+        return len(self._songs)
+
+    def get_lengths(self) -> np.ndarray:
+        return self._songs.number_of_lines
+
+    def get_song_ids(self) -> np.ndarray:
+        return self._songs.start_index
+
+    def get_labels(self) -> np.ndarray:
+        return self._songs.genre
 
     def __getitem__(self, index):
-        song_entry = self._song_entries[index]
+        embeddings = None if self.cache is None else self.cache.get(index)
 
-        embeddings_file = h5py.File(self._embeddings_file_path, 'r')
-        embeddings = None
+        if embeddings is None:
+            embeddings = self._load_embeddings(int(self._songs.start_index[index]),
+                                               int(self._songs.number_of_lines[index]))
 
-        corrupt = False
-        # TODO: Check if we shouldn't have all lines as one ELMO entry
-        for index in range(song_entry.start_index, song_entry.start_index + song_entry.number_of_lines):
-            if str(index) in embeddings_file.keys():
-                sentence_embeddings = torch.Tensor(embeddings_file[str(index)])
-
-                # if the embeddings are not initialized, initialize them,
-                # otherwise just cat this line to the previous ones
-                if embeddings is None:
-                    embeddings = sentence_embeddings
-                else:
-                    embeddings = torch.cat([embeddings, sentence_embeddings], dim=0)
-            else:
-                print('Encountered: Unable to open object (object blabla doesnt exist)', index, self.set_name)
-                corrupt = True
-                break
-        embeddings_file.close()
-        if corrupt:
-            return self.__getitem__(np.random.randint(0, self.__len__()))
+            if self.cache is not None:
+                self.cache.put(index, embeddings)
+
+        return embeddings, int(self._songs.genre[index])
+
+    def _decodes_copies(self) -> bool:
+        """ whether the loaded songs are arrays of their own, which are worth caching, instead of views """
+
+        return True
+
+    def _load_embeddings(self, start_index: int, number_of_lines: int):
+        """ reads the embeddings of a song and normalizes them if needed """
+
+        embeddings = self._read_embeddings(start_index, number_of_lines)
 
         if (self.normalize):
             embeddings = (embeddings+6)/12
-        return embeddings, int(song_entry.genre.value)
+        return embeddings
+
+    def _read_embeddings(self, start_index: int, number_of_lines: int):
+        """ reads the [lines, embedding_size] embeddings of a song """
+
+        embeddings_file = get_hdf5_file(self._embeddings_file_path)
+
+        # TODO: Check if we shouldn't have all lines as one ELMO entry
+        embeddings = [embeddings_file[str(index)][()]
+                      for index in range(start_index, start_index + number_of_lines)]
+
+        return torch.from_numpy(np.concatenate(embeddings, axis=0)).float()
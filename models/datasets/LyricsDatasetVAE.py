@@ -1,9 +1,7 @@
-from typing import List
-
 from models.datasets.LyricsDataset import LyricsDataset
-from models.entities.Song import Song
 from models.enums.Genre import Genre
 from utils.data_manager import DataManager
+from utils.song_metadata import SongMetadata
 
 
 class LyricsDatasetVAE(LyricsDataset):
@@ -12,7 +10,6 @@ class LyricsDatasetVAE(LyricsDataset):
         self.genre = genre
         super().__init__(folder, set_name, **kwargs)
 
-    def setup(self, data_manager: DataManager, set_name: str):
-        x = data_manager.load_python_obj(f'song_lyrics.{set_name}')
-        x: List[Song]
-        return [song for song in x if self.genre == song.genre]
+    def setup(self, data_manager: DataManager, set_name: str) -> SongMetadata:
+        songs = super().setup(data_manager, set_name)
+        return songs.select(songs.genre == (-1 if self.genre is None else self.genre.value))
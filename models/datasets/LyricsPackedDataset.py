@@ -0,0 +1,174 @@
+import os
+import warnings
+
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+from models.datasets.LyricsDataset import LyricsDataset
+from utils.embedding_utils import packed_embeddings_file_path, pack_embeddings, encode_embeddings, decode_rows, \
+    memmap_embeddings_file_path, memmap_scales_file_path, memmap_missing_lines_file_path, export_memmap_embeddings, \
+    memmap_line_ids_file_path, dedup_embeddings, \
+    PACKED_EMBEDDINGS_DATASET, PACKED_MISSING_DATASET, PACKED_SCALES_DATASET, PACKED_LINE_IDS_DATASET, \
+    FLOAT32_ENCODING, INT8_ENCODING, ENCODINGS
+from utils.hdf5_utils import get_hdf5_file
+from utils.song_metadata import load_song_metadata
+from utils.system_utils import get_resident_memory
+
+HDF5_BACKEND = 'hdf5'
+MEMMAP_BACKEND = 'mmap'
+
+
+class LyricsPackedDataset(LyricsDataset):
+    """
+    LyricsDataset that reads every song as one slice of a contiguous [total_lines, embedding_size] array,
+    instead of one HDF5 dataset per lyric line. with embedding_dedup every distinct line is stored once and a song is
+    gathered from the unique rows of its lines
+    """
+
+    def __init__(self, folder, set_name, embedding_backend=None, embedding_encoding=None, embedding_dedup=None,
+                 memory_report_freq=None, **kwargs):
+        arguments = kwargs.get('arguments', None)
+
+        # hdf5: packed HDF5 file read through a per-process handle
+        # mmap: raw .npy matrix that is memory-mapped, so all workers and processes share one page-cache copy
+        self.embedding_backend = embedding_backend or getattr(arguments, 'embedding_backend', HDF5_BACKEND)
+        # float32, float16 or int8 (per-row scale and offset), decoded on read
+        self.embedding_encoding = embedding_encoding or getattr(arguments, 'embedding_encoding', FLOAT32_ENCODING)
+        self.embedding_dedup = embedding_dedup or getattr(arguments, 'embedding_dedup', False)
+        self.memory_report_freq = memory_report_freq or getattr(arguments, 'memory_report_freq', 0)
+        assert self.embedding_backend in [HDF5_BACKEND, MEMMAP_BACKEND], \
+            f'Unknown embedding backend {self.embedding_backend}'
+        assert self.embedding_encoding in ENCODINGS, f'Unknown embedding encoding {self.embedding_encoding}'
+
+        self._memmap = None
+        self._memmap_scales = None
+        self._memmap_line_ids = None
+        self._items_read = 0
+
+        super(LyricsPackedDataset, self).__init__(folder, set_name, **kwargs)
+
+    def __getstate__(self):
+        # the memory-maps are reopened in the worker instead of copied into it
+        state = self.__dict__.copy()
+        state['_memmap'] = None
+        state['_memmap_scales'] = None
+        state['_memmap_line_ids'] = None
+        return state
+
+    def _setup_embeddings(self, folder, set_name):
+        float32_file_path = packed_embeddings_file_path(folder, set_name)
+        dedup_file_path = packed_embeddings_file_path(folder, set_name, dedup=True)
+        packed_file_path = packed_embeddings_file_path(folder, set_name, self.embedding_encoding, self.embedding_dedup)
+
+        if self.embedding_backend == MEMMAP_BACKEND:
+            self._embeddings_file_path = memmap_embeddings_file_path(folder, set_name, self.embedding_encoding,
+                                                                     self.embedding_dedup)
+            self._scales_file_path = memmap_scales_file_path(folder, set_name, self.embedding_encoding,
+                                                             self.embedding_dedup)
+            self._line_ids_file_path = memmap_line_ids_file_path(folder, set_name)
+            # the matrix and the companion files it is read with
+            required_file_paths = [self._embeddings_file_path, memmap_missing_lines_file_path(folder, set_name)]
+            if self.embedding_encoding == INT8_ENCODING:
+                required_file_paths.append(self._scales_file_path)
+            if self.embedding_dedup:
+                required_file_paths.append(self._line_ids_file_path)
+        else:
+            self._embeddings_file_path = packed_file_path
+            required_file_paths = [packed_file_path]
+
+        # every file is written atomically, so a file that exists is complete
+        missing_file_paths = [file_path for file_path in required_file_paths if not os.path.exists(file_path)]
+        if missing_file_paths:
+            print("%s packed embeddings not found at %s. Creating new." %
+                  (set_name.upper(), ', '.join(missing_file_paths)))
+            if not os.path.exists(float32_file_path):
+                pack_embeddings(folder, set_name, load_song_metadata(folder, set_name))
+            if self.embedding_dedup and not os.path.exists(dedup_file_path):
+                dedup_embeddings(folder, set_name)
+            if not os.path.exists(packed_file_path):
+                encode_embeddings(folder, set_name, self.embedding_encoding, self.embedding_dedup)
+            if self.embedding_backend == MEMMAP_BACKEND:
+                export_memmap_embeddings(folder, set_name, self.embedding_encoding, self.embedding_dedup)
+
+        if self.embedding_backend == MEMMAP_BACKEND:
+            total_lines = len(self._get_memmap_line_ids()) if self.embedding_dedup else self._get_memmap().shape[0]
+            missing_lines = np.load(memmap_missing_lines_file_path(folder, set_name))
+        else:
+            with h5py.File(self._embeddings_file_path, 'r') as embeddings_file:
+                lines_dataset = PACKED_LINE_IDS_DATASET if self.embedding_dedup else PACKED_EMBEDDINGS_DATASET
+                total_lines = embeddings_file[lines_dataset].shape[0]
+                missing_lines = np.asarray(embeddings_file[PACKED_MISSING_DATASET])
+
+        assert np.all(self._songs.start_index + self._songs.number_of_lines <= total_lines)
+
+        self._drop_songs_with_missing_lines(missing_lines)
+
+    def _get_memmap(self) -> np.ndarray:
+        """ memory-maps the embeddings matrix, once per process """
+
+        if self._memmap is None:
+            self._memmap = np.load(self._embeddings_file_path, mmap_mode='r')
+        return self._memmap
+
+    def _get_memmap_scales(self) -> np.ndarray:
+        """ memory-maps the per-row scales and offsets of an int8 embeddings matrix, once per process """
+
+        if self._memmap_scales is None:
+            self._memmap_scales = np.load(self._scales_file_path, mmap_mode='r')
+        return self._memmap_scales
+
+    def _get_memmap_line_ids(self) -> np.ndarray:
+        """ memory-maps the unique row of every line of a deduplicated embeddings matrix, once per process """
+
+        if self._memmap_line_ids is None:
+            self._memmap_line_ids = np.load(self._line_ids_file_path, mmap_mode='r')
+        return self._memmap_line_ids
+
+    def _decodes_copies(self) -> bool:
+        # float32 rows of the memory-map are views on the shared page cache, caching them would charge the budget for
+        # memory the cache doesn't own and save nothing. the other encodings, gathers and normalization decode copies
+        return not (self.embedding_backend == MEMMAP_BACKEND and self.embedding_encoding == FLOAT32_ENCODING
+                    and not self.embedding_dedup and not self.normalize)
+
+    def _load_embeddings(self, start_index: int, number_of_lines: int):
+        start, end = start_index, start_index + number_of_lines
+
+        int8 = self.embedding_encoding == INT8_ENCODING
+        if self.embedding_backend == MEMMAP_BACKEND:
+            embeddings = self._get_memmap()
+            scales = self._get_memmap_scales() if int8 else None
+            line_ids = self._get_memmap_line_ids()[start:end] if self.embedding_dedup else None
+        else:
+            embeddings_file = get_hdf5_file(self._embeddings_file_path)
+            embeddings = embeddings_file[PACKED_EMBEDDINGS_DATASET]
+            scales = embeddings_file[PACKED_SCALES_DATASET] if int8 else None
+            line_ids = embeddings_file[PACKED_LINE_IDS_DATASET][start:end] if self.embedding_dedup else None
+
+        if line_ids is None:
+            rows = embeddings[start:end]
+            scales = None if scales is None else scales[start:end]
+        else:
+            # gather over the unique rows, a line repeated within the song is read once
+            unique_ids, inverse = np.unique(line_ids, return_inverse=True)
+            rows = embeddings[unique_ids][inverse]
+            scales = None if scales is None else scales[unique_ids][inverse]
+
+        with warnings.catch_warnings():
+            # float32 memory-mapped rows stay a read-only view, which is fine because they are never written to
+            warnings.simplefilter('ignore', UserWarning)
+            embeddings = torch.from_numpy(decode_rows(rows, scales, self.normalize))
+
+        self._items_read += 1
+        if self.memory_report_freq > 0 and (self._items_read % self.memory_report_freq) == 0:
+            self._report_memory()
+
+        return embeddings
+
+    def _report_memory(self):
+        worker_info = get_worker_info()
+        worker = 'main' if worker_info is None else f'worker {worker_info.id}'
+        memory = get_resident_memory()
+        print(f'-- Memory {self.set_name} ({worker}, pid {os.getpid()}): '
+              + ', '.join(f'{key} {value:.1f} MB' for key, value in memory.items()))
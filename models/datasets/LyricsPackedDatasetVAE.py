@@ -0,0 +1,10 @@
+from models.datasets.LyricsDatasetVAE import LyricsDatasetVAE
+from models.datasets.LyricsPackedDataset import LyricsPackedDataset
+
+
+class LyricsPackedDatasetVAE(LyricsPackedDataset, LyricsDatasetVAE):
+    """
+    genre-specific LyricsPackedDataset, to train the VAE of one genre on the packed or memory-mapped embeddings
+    """
+
+    pass
@@ -0,0 +1,128 @@
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from models.datasets.BaseDataset import BaseDataset
+from models.enums.Genre import Genre
+from utils.constants import *
+from utils.dataloader_utils import PaddedBatchCollator
+from utils.model_utils import find_right_model
+
+
+class PairedBatchCollator:
+    """
+    collate function of the LyricsPairedDataset, collates both halves of the records with their own collate function.
+    the batch is ordered by embedding length first, so the sorting embeddings collate keeps both halves aligned
+    """
+
+    def __init__(self, embedding_collate, sentence_collate, embedding_items: int):
+        self.embedding_collate = embedding_collate
+        self.sentence_collate = sentence_collate
+        self.embedding_items = embedding_items
+
+    def __call__(self, DataLoaderBatch):
+        lengths = np.asarray([len(record[0]) for record in DataLoaderBatch])
+        DataLoaderBatch = [DataLoaderBatch[index] for index in np.argsort(-lengths, kind='stable')]
+
+        return (self.embedding_collate([record[:self.embedding_items] for record in DataLoaderBatch]),
+                self.sentence_collate([record[self.embedding_items:] for record in DataLoaderBatch]))
+
+
+class LyricsPairedDataset(BaseDataset):
+    """
+    yields aligned (embeddings, label, sentence items...) records of the songs that are in both the embeddings dataset
+    of the classifier and the sentence dataset of the VAE, so combined testing and joint training need one loader
+    """
+
+    def __init__(self, folder, set_name, genre: Genre = None, normalize: bool = False, arguments=None,
+                 embedding_dataset_class=None, sentence_dataset_class=None, **kwargs):
+        super(LyricsPairedDataset, self).__init__()
+
+        self.arguments = arguments
+        self.embedding_dataset = find_right_model(DATASETS,
+                                                  embedding_dataset_class or arguments.dataset_class,
+                                                  folder=folder,
+                                                  set_name=set_name,
+                                                  genre=genre,
+                                                  normalize=normalize,
+                                                  arguments=arguments)
+        self.sentence_dataset = find_right_model(DATASETS,
+                                                 sentence_dataset_class or arguments.dataset_class_sentencevae,
+                                                 folder=folder,
+                                                 set_name=set_name,
+                                                 genre=genre,
+                                                 normalize=normalize,
+                                                 arguments=arguments)
+        # the collate function of this dataset decides the order of the records
+        if hasattr(self.sentence_dataset, 'sort_batches'):
+            self.sentence_dataset.sort_batches = False
+
+        # pair the items of both datasets by song
+        _, self._embedding_items, self._sentence_items = np.intersect1d(self.embedding_dataset.get_song_ids(),
+                                                                        self.sentence_dataset.get_song_ids(),
+                                                                        assume_unique=True,
+                                                                        return_indices=True)
+        # keep the order of the embeddings dataset
+        order = np.argsort(self._embedding_items, kind='stable')
+        self._embedding_items = self._embedding_items[order]
+        self._sentence_items = self._sentence_items[order]
+
+        print('-- Loaded paired dataset:', set_name, '- size:', self.__len__())
+
+    def __len__(self):
+        return len(self._embedding_items)
+
+    def __getitem__(self, index):
+        embedding_record = self.embedding_dataset[int(self._embedding_items[index])]
+        sentence_record = self.sentence_dataset[int(self._sentence_items[index])]
+        return tuple(embedding_record) + tuple(sentence_record)
+
+    def get_lengths(self) -> np.ndarray:
+        return self.embedding_dataset.get_lengths()[self._embedding_items]
+
+    def get_song_ids(self) -> np.ndarray:
+        return self.embedding_dataset.get_song_ids()[self._embedding_items]
+
+    def get_labels(self) -> np.ndarray:
+        return self.embedding_dataset.get_labels()[self._embedding_items]
+
+    def use_collate_function(self) -> bool:
+        return False
+
+    def yields_pairs(self) -> bool:
+        return True
+
+    def collate_function(self):
+        embedding_collate = self._padded_batch_collator()
+
+        sentence_collate = self.sentence_dataset.collate_function()
+        if sentence_collate is None:
+            sentence_collate = self._padded_batch_collator() if self.sentence_dataset.use_collate_function() \
+                else default_collate
+
+        return PairedBatchCollator(embedding_collate, sentence_collate, embedding_items=2)
+
+    def _padded_batch_collator(self) -> PaddedBatchCollator:
+        return PaddedBatchCollator(dtype=getattr(torch, getattr(self.arguments, 'collate_dtype', 'float32')),
+                                   pad_value=getattr(self.arguments, 'pad_value', 0.0),
+                                   number_of_buffers=getattr(self.arguments, 'collate_buffers', 0))
+
+    @property
+    def vocab_size(self):
+        return self.sentence_dataset.vocab_size
+
+    @property
+    def pad_idx(self):
+        return self.sentence_dataset.pad_idx
+
+    @property
+    def sos_idx(self):
+        return self.sentence_dataset.sos_idx
+
+    @property
+    def eos_idx(self):
+        return self.sentence_dataset.eos_idx
+
+    @property
+    def unk_idx(self):
+        return self.sentence_dataset.unk_idx
@@ -1,18 +1,17 @@
 import os
-import io
 import json
 import torch
 import numpy as np
 from typing import List, Tuple
-from collections import defaultdict
 from torch.utils.data import Dataset
-from nltk.tokenize import word_tokenize
 
 from utils.constants import *
-from utils.dataloader_utils import OrderedCounter
+from utils.dataloader_utils import OrderedCounter, TokenBatchCollator
 from utils.data_manager import DataManager
+from utils.song_metadata import SongMetadata, load_song_metadata
+from utils.system_utils import atomic_write
+from utils.tokenization_utils import tokenize_lyrics, TokenizationCache
 
-from models.entities.Song import Song
 from models.enums.Genre import Genre
 from models.datasets.BaseDataset import BaseDataset
 
@@ -26,22 +25,36 @@ class LyricsRawDataset(BaseDataset):
         self.max_sequence_length = kwargs.get('max_sequence_length', 500)
         self.min_occ = kwargs.get('min_occ', 3)
         self.genre = genre
+        # 0 tokenizes on all cores
+        self.tokenize_processes = getattr(kwargs.get('arguments', None), 'tokenize_processes', 0) or None
+        # sorted batches let the SentenceVAE skip its own sort and unsort
+        self.sort_batches = getattr(kwargs.get('arguments', None), 'sort_token_batches', False)
 
         data_manager = DataManager(folder)
 
-        # load the song entries pickle
-        song_entries = self.setup(data_manager, set_name)
-
-        self.data_file = f'lyrics.{set_name}.{genre}.json'
+        # load the columnar song metadata
+        songs = self.setup(data_manager, set_name)
+        self._start_indices = songs.start_index
+        self._genres = songs.genre
+
+        # one corpus per set, shared by all genres: a flat int32 array of the untruncated [<sos>, words..., <eos>]
+        # token ids of all songs, the [offset, length] of every song, and the songs grouped by genre
+        # with the [start, end) of every genre in them
+        self.data_file = f'lyrics.{set_name}.tokens.npy'
+        self.index_file = f'lyrics.{set_name}.index.npy'
+        self.genre_songs_file = f'lyrics.{set_name}.genre_songs.npy'
+        self.genre_offsets_file = f'lyrics.{set_name}.genre_offsets.npy'
         self.vocab_file = f'lyrics.vocab.json'
+        self._arrays = {}
 
         if create_data:
             print("Creating new %s ptb data."%set_name.upper())
-            self._create_data(song_entries)
+            self._create_data(songs)
 
-        elif not os.path.exists(os.path.join(self.data_dir, self.data_file)):
+        elif not all([os.path.exists(os.path.join(self.data_dir, file))
+                      for file in [self.data_file, self.index_file, self.genre_songs_file, self.genre_offsets_file]]):
             print("%s preprocessed file not found at %s. Creating new."%(set_name.upper(), os.path.join(self.data_dir, self.data_file)))
-            self._create_data(song_entries)
+            self._create_data(songs)
 
         else:
             self._load_data()
@@ -49,20 +62,62 @@ class LyricsRawDataset(BaseDataset):
         print('-- Loaded dataset:', set_name, '- size:', self.__len__())
 
 
+    def __getstate__(self):
+        # the memory-maps are reopened in the worker instead of copied into it
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
     def use_collate_function(self) -> bool:
         return False
 
-    def setup(self, data_manager: DataManager, set_name: str) -> List[Song]:
-        x: List[Song] = data_manager.load_python_obj(f'song_lyrics.{set_name}')
-        return x
+    def collate_function(self):
+        return TokenBatchCollator(self.pad_idx, sort=self.sort_batches)
+
+    def setup(self, data_manager: DataManager, set_name: str) -> SongMetadata:
+        return load_song_metadata(data_manager.directory, set_name)
 
     def __len__(self):
-        return len(self.data)
+        return self._number_of_songs
+
+    def get_lengths(self) -> np.ndarray:
+        lengths = self._get_array(self.index_file)[self._get_songs(), 1]
+        return np.minimum(lengths, self.max_sequence_length)
+
+    def get_song_ids(self) -> np.ndarray:
+        return self._start_indices[self._get_songs()]
+
+    def get_labels(self) -> np.ndarray:
+        return self._genres[self._get_songs()]
 
     def __getitem__(self, idx):
-        idx = str(idx)
+        song = idx if self.genre is None else self._get_songs()[idx]
+        offset, length = self._get_array(self.index_file)[song]
+        length = min(length, self.max_sequence_length)
+
+        # the target is the input shifted by one token, both are padded by the collate function
+        tokens = self._get_array(self.data_file)[offset:offset + length + 1].astype(np.int64)
+        if length == self.max_sequence_length:
+            tokens[-1] = self.eos_idx
+
+        return tokens[:-1], tokens[1:], int(length)
+
+    def _get_array(self, file_name: str) -> np.ndarray:
+        """ memory-maps one of the corpus arrays, once per process """
 
-        return (np.asarray(self.data[idx]['input'], dtype=np.int64), np.asarray(self.data[idx]['target'], dtype=np.int64), self.data[idx]['length'])
+        array = self._arrays.get(file_name)
+        if array is None:
+            array = np.load(os.path.join(self.data_dir, file_name), mmap_mode='r')
+            self._arrays[file_name] = array
+        return array
+
+    def _get_songs(self):
+        """ returns the songs of the genre as a view on the genre index, or all songs """
+
+        if self.genre is None:
+            return slice(None)
+        start, end = self._get_array(self.genre_offsets_file)[self.genre.value:self.genre.value + 2]
+        return self._get_array(self.genre_songs_file)[start:end]
 
 
     @property
@@ -93,8 +148,11 @@ class LyricsRawDataset(BaseDataset):
 
     def _load_data(self, vocab=True):
 
-        with open(os.path.join(self.data_dir, self.data_file), 'r', encoding='utf-8') as file:
-            self.data = json.load(file)
+        self._arrays = {}
+        if self.genre is None:
+            self._number_of_songs = len(self._get_array(self.index_file))
+        else:
+            self._number_of_songs = len(self._get_songs())
         if vocab:
             with open(os.path.join(self.data_dir, self.vocab_file), 'r', encoding='utf-8') as file:
                 vocab = json.load(file)
@@ -106,49 +164,53 @@ class LyricsRawDataset(BaseDataset):
 
         self.w2i, self.i2w = vocab['w2i'], vocab['i2w']
 
-    def _create_data(self, song_entries):
+    def _create_data(self, songs: SongMetadata):
+
+        create_vocab = self.split == TRAIN_SET and not os.path.exists(os.path.join(self.data_dir, self.vocab_file))
 
-        if self.split == TRAIN_SET and not os.path.exists(os.path.join(self.data_dir, self.vocab_file)):
-            self._create_vocab(song_entries)
+        if create_vocab:
+            # a single tokenization pass feeds both the vocabulary and the tokenization cache
+            lyrics = songs.all_lyrics()
+            tokenized_songs = tokenize_lyrics(lyrics, self.tokenize_processes)
+            self._create_vocab(tokenized_songs)
+            cache = TokenizationCache(self.data_dir, self.vocab_file)
+            cache.put(lyrics, tokenized_songs, self.w2i)
         else:
             self._load_vocab()
+            cache = TokenizationCache(self.data_dir, self.vocab_file)
 
-        data = defaultdict(dict)
-        # with open(self.raw_data_path, 'r', encoding='utf-8') as file:
-
-        for song_entry in song_entries:
-            if song_entry.genre != self.genre and self.genre != None:
-                continue
-
-            words = word_tokenize(song_entry.lyrics)
-
-            input = ['<sos>'] + words
-            input = input[:self.max_sequence_length]
-
-            target = words[:self.max_sequence_length-1]
-            target = target + ['<eos>']
+        encoded_songs = cache.encode(songs.all_lyrics(), self.w2i,
+                                     self.tokenize_processes)
 
-            assert len(input) == len(target), "%i, %i"%(len(input), len(target))
-            length = len(input)
+        sos, eos = np.int32(self.sos_idx), np.int32(self.eos_idx)
+        sequences = []
 
-            input.extend(['<pad>'] * (self.max_sequence_length-length))
-            target.extend(['<pad>'] * (self.max_sequence_length-length))
+        for words in encoded_songs:
+            # input is sequence[:-1] and target is sequence[1:], truncated to max_sequence_length on read
+            sequences.append(np.concatenate([[sos], words, [eos]]).astype(np.int32))
 
-            input = [self.w2i.get(w, self.w2i['<unk>']) for w in input]
-            target = [self.w2i.get(w, self.w2i['<unk>']) for w in target]
+        lengths = np.asarray([len(sequence) - 1 for sequence in sequences], dtype=np.int64)
+        offsets = np.zeros(len(sequences), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths + 1)[:-1]
+        tokens = np.concatenate(sequences) if sequences else np.zeros(0, dtype=np.int32)
 
-            id = len(data)
-            data[id]['input'] = input
-            data[id]['target'] = target
-            data[id]['length'] = length
+        genres = songs.genre
+        genre_songs = np.argsort(genres, kind='stable')
+        genre_offsets = np.zeros(len(Genre) + 1, dtype=np.int64)
+        genre_offsets[1:] = np.cumsum(np.bincount(genres, minlength=len(Genre)))
 
-        with io.open(os.path.join(self.data_dir, self.data_file), 'wb') as data_file:
-            data = json.dumps(data, ensure_ascii=False)
-            data_file.write(data.encode('utf8', 'replace'))
+        # every file is replaced only once it is complete, so other runs that share the corpus never read it
+        # half-written, the genre offsets that complete the set of files come last
+        for file_name, array in [(self.data_file, tokens),
+                                 (self.index_file, np.stack([offsets, lengths], axis=1)),
+                                 (self.genre_songs_file, genre_songs),
+                                 (self.genre_offsets_file, genre_offsets)]:
+            with atomic_write(os.path.join(self.data_dir, file_name)) as array_file:
+                np.save(array_file, array)
 
         self._load_data(vocab=False)
 
-    def _create_vocab(self, song_entries):
+    def _create_vocab(self, tokenized_songs: List[List[str]]):
 
         assert self.split == TRAIN_SET, "Vocabulary can only be created for training file."
 
@@ -161,8 +223,7 @@ class LyricsRawDataset(BaseDataset):
             i2w[len(w2i)] = st
             w2i[st] = len(w2i)
 
-        for song_entry in song_entries:
-            words = word_tokenize(song_entry.lyrics)
+        for words in tokenized_songs:
             w2c.update(words)
 
         for w, c in w2c.items():
@@ -175,7 +236,7 @@ class LyricsRawDataset(BaseDataset):
         print("Vocabulary of %i keys created." %len(w2i))
 
         vocab = dict(w2i=w2i, i2w=i2w)
-        with io.open(os.path.join(self.data_dir, self.vocab_file), 'wb') as vocab_file:
+        with atomic_write(os.path.join(self.data_dir, self.vocab_file)) as vocab_file:
             data = json.dumps(vocab, ensure_ascii=False)
             vocab_file.write(data.encode('utf8', 'replace'))
 
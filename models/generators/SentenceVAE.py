@@ -79,8 +79,12 @@ class SentenceVAE(GeneralModel):
 
     def forward(self, input_sequence, lengths, step, **kwargs):
         batch_size = input_sequence.size(0)
-        sorted_lengths, sorted_idx = torch.sort(lengths, descending=True)
-        input_sequence = input_sequence[sorted_idx]
+        # batches of a sorting collate function are already ordered from longest to shortest
+        if bool((lengths[:-1] >= lengths[1:]).all()):
+            sorted_lengths, sorted_idx = lengths, None
+        else:
+            sorted_lengths, sorted_idx = torch.sort(lengths, descending=True)
+            input_sequence = input_sequence[sorted_idx]
 
         # ENCODER
         input_embedding = self.embedding(input_sequence)
@@ -132,8 +136,9 @@ class SentenceVAE(GeneralModel):
         # process outputs
         padded_outputs = rnn_utils.pad_packed_sequence(outputs, batch_first=True)[0]
         padded_outputs = padded_outputs.contiguous()
-        _, reversed_idx = torch.sort(sorted_idx)
-        padded_outputs = padded_outputs[reversed_idx]
+        if sorted_idx is not None:
+            _, reversed_idx = torch.sort(sorted_idx)
+            padded_outputs = padded_outputs[reversed_idx]
         b, s, _ = padded_outputs.size()
 
         # project outputs to vocab
@@ -3,6 +3,7 @@ from models.losses import CrossEntropyLoss, MSE_ELBO
 from models.GeneralModel import GeneralModel
 from utils.model_utils import find_right_model
 from utils.constants import *
+from utils.metric_utils import MetricAccumulator
 # this is a dummy, please make your own versions that inherets from general model and implements forward
 
 class Cross_ELBO(GeneralModel):
@@ -12,16 +13,17 @@ class Cross_ELBO(GeneralModel):
         self.CE = find_right_model(LOSS_DIR, 'CrossEntropyLoss', dataset_options=dataset_options, device=device).to(device)
 
         self.MSE_ELBO = find_right_model(LOSS_DIR, 'MSE_ELBO', dataset_options=dataset_options, device=device).to(device)
-        self.saved_losses = {'ce': None, 'mseelbo': None}
+        self.saved_losses = MetricAccumulator(['ce', 'mseelbo'])
 
     def forward(self, y, x, recons, yhat, mean, std):
         mse_elbo = self.MSE_ELBO(None, mean, std, recons, x)
         ce = self.CE(y, yhat)
-        self.saved_losses = {'ce': ce.item(), 'mseelbo': mse_elbo.item()}
+        self.saved_losses.add(ce=ce, mseelbo=mse_elbo)
         return mse_elbo + ce
 
     def reset(self):
         self.MSE_ELBO.reset()
+        self.saved_losses.reset()
 
     def get_losses(self):
-        return self.saved_losses
+        return self.saved_losses.means()
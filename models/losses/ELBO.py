@@ -3,6 +3,7 @@ import torch.distributions as dd
 import torch.nn as nn
 
 from models.GeneralModel import GeneralModel
+from utils.metric_utils import MetricAccumulator
 
 
 ######## inspired by; https://github.com/kefirski/contiguous-succotash
@@ -10,8 +11,8 @@ from models.GeneralModel import GeneralModel
 class ELBO(GeneralModel):
 
     def __init__(self, device="cpu", **kwargs):
-        self.losses = {"recon": 0, "reg": 0}
-        self.evaluations = 0
+        # running means of the batch losses, kept on the device until they are logged
+        self.losses = MetricAccumulator(["recon", "reg"])
         self.normal = None
         super(ELBO, self).__init__(0, device=device, **kwargs)
 
@@ -20,15 +21,13 @@ class ELBO(GeneralModel):
         calculates negated-ELBO loss
         """
 
-        self.evaluations += 1
         x = x.float()
 
         # regularisation loss
         loss_reg = self.get_reg_loss(std, mean).mean()
         loss_recon = self.get_recon_loss(x, reconstructed_mean).mean()
 
-        self.losses["recon"] += loss_recon.item()
-        self.losses["reg"] += loss_reg.item()
+        self.losses.add(recon=loss_recon, reg=loss_reg)
 
         # average over batch size
         return loss_recon + loss_reg  # / batch_size
@@ -37,12 +36,10 @@ class ELBO(GeneralModel):
         raise NotImplementedError("overrided by childclass! please choose one")
 
     def get_losses(self):
-        return {key: value / self.evaluations for key, value in self.losses.items()}
+        return self.losses.means()
 
     def reset(self):
-        self.losses["recon"] = 0
-        self.losses["reg"] = 0
-        self.evaluations = 0
+        self.losses.reset()
 
     def get_reg_loss(self, std, mean):
         return - 0.5 * torch.sum(1 + torch.log(std ** 2) - mean ** 2 - std ** 2, dim=-1)
@@ -52,8 +49,6 @@ class ELBO(GeneralModel):
         calculates negated-ELBO loss
         """
 
-        self.evaluations += 1
-
         x = x.float()
         loss_reg = self.get_reg_loss(std, mean)
         loss_recon = self.get_recon_loss(x, reconstructed_mean) #nn.MSELoss(reduction='none')(reconstructed_mean, x)
@@ -3,14 +3,15 @@ import torch.nn as nn
 import numpy as np
 
 from models.GeneralModel import GeneralModel
+from utils.metric_utils import MetricAccumulator
 
 class VAELoss(GeneralModel):
 
     def __init__(self, dataset_options, device="cpu", test_mode=False,
     **kwargs):
         super(VAELoss, self).__init__(0, device, **kwargs)
-        self.losses = {"recon": 0, "reg": 0}
-        self.evaluations = 0
+        # running means of the batch losses, kept on the device until they are logged
+        self.losses = MetricAccumulator(["recon", "reg"])
         self.test_mode = test_mode
         self.NLL = torch.nn.NLLLoss(size_average=False, ignore_index=dataset_options.pad_idx)
 
@@ -28,10 +29,11 @@ class VAELoss(GeneralModel):
 
         # return NLL_loss, KL_loss, KL_weight
         loss = (NLL_loss + KL_weight * KL_loss)/batch_size
+        self.losses.add(recon=NLL_loss / batch_size, reg=KL_weight * KL_loss / batch_size)
         return loss
 
     def get_losses(self):
-        return {key: value / 1 for key, value in self.losses.items()}
+        return self.losses.means()
 
     def kl_anneal_function(self, anneal_function, step, k, x0, test_mode=True):
         if anneal_function == 'logistic':
@@ -41,6 +43,4 @@ class VAELoss(GeneralModel):
 
 
     def reset(self):
-        self.losses["recon"] = 0
-        self.losses["reg"] = 0
-        self.evaluations = 0
\ No newline at end of file
+        self.losses.reset()
\ No newline at end of file
@@ -0,0 +1,26 @@
+import os
+import sys
+
+sys.path.append('..')
+
+from utils.embedding_utils import pack_embeddings, dedup_embeddings, packed_embeddings_file_path
+from utils.song_metadata import load_song_metadata
+from utils.system_utils import ensure_current_directory
+
+# writes the deduplicated embeddings.{set}.packed.dedup.hdf5 files, which are read by the LyricsPackedDataset
+# with --embedding_dedup, and reports how many lines are unique
+
+ensure_current_directory()
+main_path = os.path.join('local_data', 'data')
+
+total_lines, unique_lines, bytes_saved = 0, 0, 0
+for set_name in ['train', 'validation', 'test']:
+    if not os.path.exists(packed_embeddings_file_path(main_path, set_name)):
+        pack_embeddings(main_path, set_name, load_song_metadata(main_path, set_name))
+
+    report = dedup_embeddings(main_path, set_name)
+    total_lines += report['total_lines']
+    unique_lines += report['unique_lines']
+    bytes_saved += report['bytes_saved']
+
+print(f'Deduplicated all sets: {unique_lines}/{total_lines} unique lines, {bytes_saved / 2 ** 20:.1f} MB saved')
@@ -0,0 +1,105 @@
+import argparse
+import os
+import sys
+
+sys.path.append('..')
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from models.datasets.LyricsPackedDataset import LyricsPackedDataset
+from utils.constants import *
+from utils.data_manager import DataManager
+from utils.dataloader_utils import PaddedBatchCollator
+from utils.embedding_utils import encode_embeddings, packed_embeddings_file_path, pack_embeddings, ENCODINGS
+from utils.song_metadata import load_song_metadata
+from utils.system_utils import ensure_current_directory
+
+
+# writes float16/int8 versions of the packed embeddings and, given a trained LSTMClassifier, checks its
+# accuracy on the encoded embeddings against the float32 ones
+
+
+def load_classifier(arguments: argparse.Namespace):
+    """ loads the state dict of a trained LSTMClassifier """
+
+    # imported here, model_utils reads the model folders relative to the main directory
+    from utils.model_utils import find_right_model
+
+    classifier = find_right_model(CLASS_DIR, 'LSTMClassifier',
+                                  num_classes=arguments.num_classes,
+                                  hidden_dim=arguments.hidden_dim,
+                                  embedding_size=arguments.embedding_size,
+                                  device=arguments.device).to(arguments.device)
+
+    datamanager = DataManager(os.path.join(GITIGNORED_DIR, RESULTS_DIR, arguments.classifier_dir))
+    loaded = datamanager.load_python_obj(os.path.join('models', arguments.classifier_name))
+    # save_models stores the state dict of the classifier under its class
+    classifier.load_state_dict(next(iter(loaded.values())))
+    classifier.eval()
+
+    return classifier
+
+
+def compare_encodings(arguments: argparse.Namespace, classifier):
+    """ runs the classifier on the float32 and the encoded embeddings of the same songs """
+
+    from utils.model_utils import calculate_accuracy
+
+    loaders = [DataLoader(LyricsPackedDataset(arguments.data_folder, arguments.set_name,
+                                              normalize=arguments.normalize_data, embedding_encoding=encoding),
+                          batch_size=arguments.batch_size,
+                          collate_fn=PaddedBatchCollator())
+               for encoding in ['float32', arguments.encoding]]
+
+    accuracies, agreements, errors, sizes = [[], []], [], [], []
+    with torch.no_grad():
+        for (batch, targets, lengths), (batch_encoded, _, _) in zip(*loaders):
+            errors.append((batch - batch_encoded).abs().max().item())
+
+            predictions = []
+            for i, inputs in enumerate([batch, batch_encoded]):
+                output = classifier.forward(inputs.to(arguments.device), lengths=lengths)
+                accuracies[i].append(calculate_accuracy(targets.to(arguments.device), *output).item())
+                predictions.append(output[0].argmax(dim=-1))
+
+            agreements.append(predictions[0].eq(predictions[1]).float().mean().item())
+            sizes.append(len(targets))
+
+    print(f'float32 accuracy: {np.average(accuracies[0], weights=sizes):.4f} | '
+          f'{arguments.encoding} accuracy: {np.average(accuracies[1], weights=sizes):.4f} | '
+          f'same predictions: {np.average(agreements, weights=sizes):.4f} | '
+          f'max embedding error: {max(errors):.6f}')
+
+
+def parse() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--encoding', default="int8", type=str, help='float16/int8')
+    parser.add_argument('--data_folder', default=os.path.join('local_data', 'data'), type=str, help='data folder path')
+    parser.add_argument('--set_name', default=VALIDATION_SET, type=str, help='set to check the accuracy on')
+    parser.add_argument('--classifier_dir', default="", type=str, help='classifier state-dict dir, skip check if empty')
+    parser.add_argument('--classifier_name', default="model_best", type=str, help='classifier state-dict name')
+    parser.add_argument('--hidden_dim', default=64, type=int, help='hidden dim of the classifier')
+    parser.add_argument('--embedding_size', default=256, type=int, help='size of embeddings')
+    parser.add_argument('--num_classes', default=5, type=int, help='number of classes')
+    parser.add_argument('--batch_size', default=64, type=int, help='size of batches')
+    parser.add_argument('--normalize_data', action='store_true', help='normalize data')
+    parser.add_argument('--device', default="cpu", type=str, help='cpu/cuda')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ensure_current_directory()
+    arguments = parse()
+    assert arguments.encoding in ENCODINGS
+
+    for set_name in [TRAIN_SET, VALIDATION_SET, TEST_SET]:
+        if not os.path.exists(packed_embeddings_file_path(arguments.data_folder, set_name)):
+            pack_embeddings(arguments.data_folder, set_name, load_song_metadata(arguments.data_folder, set_name))
+        encode_embeddings(arguments.data_folder, set_name, arguments.encoding)
+
+    if arguments.classifier_dir:
+        compare_encodings(arguments, load_classifier(arguments))
@@ -0,0 +1,17 @@
+import os
+import sys
+
+sys.path.append('..')
+
+from utils.embedding_utils import pack_embeddings
+from utils.song_metadata import load_song_metadata
+from utils.system_utils import ensure_current_directory
+
+# converts the per-line embeddings.{set}.hdf5 files into packed embeddings.{set}.packed.hdf5 files,
+# which are read by the LyricsPackedDataset
+
+ensure_current_directory()
+main_path = os.path.join('local_data', 'data')
+
+for set_name in ['train', 'validation', 'test']:
+    pack_embeddings(main_path, set_name, load_song_metadata(main_path, set_name))
@@ -1,138 +1,244 @@
+import argparse
+import hashlib
+import heapq
 import os
-import csv
-import numpy as np
+import pickle
 import sys
-import re
+import tempfile
+from collections import deque
+from multiprocessing import Pool
+
+import pandas as pd
 
 sys.path.append('..')
 
-from utils.data_manager import DataManager
+from utils.song_metadata import write_song_metadata
 from utils.system_utils import ensure_current_directory
 from models.entities.Song import Song
 from models.enums.Genre import Genre
 
-def save_dataset_text(song_entries, embeddings_folder_path, filename):
-    embeddings_filename = os.path.join(embeddings_folder_path, filename)
-    with open(embeddings_filename, 'w', encoding='utf8') as embeddings_file:
-        # for _, song_entries in dataset.items():
-        for song_entry in song_entries:
-            embeddings_file.write(f'{song_entry.lyrics}\n')
+SPLITS = ['train', 'validation', 'test']
+# upper bounds of the [0, 1) hash of a song per split
+SPLIT_BOUNDS = [0.7, 0.8, 1.0]
 
-ensure_current_directory()
-main_path = os.path.join('local_data', 'data')
 
-dataset_folder_path = os.path.join(main_path, '380000-lyrics-from-metrolyrics')
-if not os.path.exists(dataset_folder_path):
-    raise Exception('Dataset folder does not exist')
+class GenreStatistics:
+    """ streaming per-genre statistics of the lyrics, updated song by song """
 
-dataset_file_path = os.path.join(dataset_folder_path, 'lyrics.csv')
-if not os.path.exists(dataset_file_path):
-    raise Exception('Dataset file does not exist')
+    def __init__(self):
+        self.count = 0
+        self.min_length = None
+        self.max_length = None
+        self.sum_length = 0
+        self.sum_words = 0
+        self.sum_unique_words = 0
+        self.split_counts = {split: 0 for split in SPLITS}
 
-with open(dataset_file_path, 'r', encoding="utf8") as dataset_file:
-    next(dataset_file)  # skip the first line - headers
-    dataset_reader = csv.reader(dataset_file, delimiter=',')
+    def update(self, song_entry: Song, split: str):
+        length = len(song_entry.lyrics)
+        self.count += 1
+        self.min_length = length if self.min_length is None else min(self.min_length, length)
+        self.max_length = length if self.max_length is None else max(self.max_length, length)
+        self.sum_length += length
+        self.sum_words += song_entry.number_of_words
+        self.sum_unique_words += song_entry.number_of_unique_words
+        self.split_counts[split] += 1
 
-    classes_to_skip = ['Other', 'Not Available']
+    def __str__(self):
+        return f'min: {self.min_length} | n_words: {self.sum_words / self.count} | ' \
+               f'unique_words: {self.sum_unique_words / self.count} | max: {self.max_length} | ' \
+               f'mean: {self.sum_length / self.count} | all: {self.count} | ' \
+               + ' | '.join(f'{split}: {count}' for split, count in self.split_counts.items())
+
+
+def lyrics_length(song_entry: Song) -> int:
+    return len(song_entry.lyrics)
+
+
+def read_run(run_file_path: str):
+    """ yields the songs of a spilled run one by one """
+
+    with open(run_file_path, 'rb') as run_file:
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+
+class SongSorter:
+    """
+    external merge sort of the songs of a split by lyrics length: songs are buffered up to max_songs, then sorted
+    and spilled to a run file in folder. the runs are merged lazily, so at most one buffer of songs is in memory
+    """
+
+    def __init__(self, folder: str, max_songs: int):
+        self.folder = folder
+        self.max_songs = max_songs
+        self._buffer = []
+        self._run_file_paths = []
+
+    def add(self, song_entry: Song):
+        self._buffer.append(song_entry)
+        if len(self._buffer) >= self.max_songs:
+            self._spill()
 
-    song_entries_by_genre = {}
+    def _spill(self):
+        if len(self._buffer) == 0:
+            return
+
+        file_descriptor, run_file_path = tempfile.mkstemp(suffix='.run', dir=self.folder)
+        with os.fdopen(file_descriptor, 'wb') as run_file:
+            for song_entry in sorted(self._buffer, key=lyrics_length):
+                pickle.dump(song_entry, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._run_file_paths.append(run_file_path)
+        self._buffer = []
+
+    def sorted_songs(self):
+        """ all songs sorted by lyrics length, songs of equal length stay in the order they were added """
+
+        self._spill()
+        # the merge is stable over the runs, which are in the order of the songs
+        return heapq.merge(*[read_run(run_file_path) for run_file_path in self._run_file_paths], key=lyrics_length)
+
+
+def numbered_songs(song_entries, embeddings_file_path: str, totals: dict):
+    """
+    passes the sorted songs of a split through, numbering their first lines, writing their lyrics to the embeddings
+    text and adding them to the totals on the way
+    """
 
     lines_counter = 0
+    with open(embeddings_file_path, 'w', encoding='utf8') as embeddings_file:
+        for song_entry in song_entries:
+            song_entry.start_index = lines_counter
+            lines_counter += song_entry.number_of_lines
+
+            totals['lines'] += song_entry.number_of_lines
+            totals['words'] += song_entry.number_of_words
+            totals['chars'] += song_entry.number_of_chars
+            totals['songs'] += 1
+
+            embeddings_file.write(f'{song_entry.lyrics}\n')
+            yield song_entry
+
+
+def split_of(lyrics: str) -> str:
+    """ deterministic train/validation/test assignment from a hash of the raw lyrics """
+
+    position = int(hashlib.sha1(lyrics.encode('utf-8')).hexdigest()[:8], 16) / 2 ** 32
+    for split, bound in zip(SPLITS, SPLIT_BOUNDS):
+        if position < bound:
+            return split
+    return SPLITS[-1]
 
-    for _, row in enumerate(dataset_reader):
-        if row[4] in classes_to_skip:
+
+def process_chunk(chunk: pd.DataFrame):
+    """ filtering and cleanup task, returns the (genre label, split, song) of the usable rows of a csv chunk """
+
+    classes_to_skip = ['Other', 'Not Available']
+    songs = []
+
+    for genre_label, lyrics in zip(chunk['genre'], chunk['lyrics']):
+        if genre_label in classes_to_skip:
             continue
 
         # Cut off songs which have lyrics with less than 30 characters
-        if len(row[5]) < 100:
+        if len(lyrics) < 100:
             continue
-        
-        if not any(c.isalpha() for c in row[5]):
+
+        if not any(c.isalpha() for c in lyrics):
             continue
 
-        song_genre = Genre.from_str(row[4])
-        
+        song_genre = Genre.from_str(genre_label)
+
         # if the song genre is None, it means it's not supported, so we skip this song
         if not song_genre:
             continue
 
-        song_entry = Song(song_genre, row[5])
-
-        if row[4] not in song_entries_by_genre.keys():
-            song_entries_by_genre[row[4]] = [song_entry]
-        else:
-            song_entries_by_genre[row[4]].append(song_entry)
-
-genres = list(song_entries_by_genre.keys())
-songs_limit = 13000
-for genre in genres:
-    song_entries_by_genre[genre] = song_entries_by_genre[genre][:songs_limit]
-
-train_data, validation_data, test_data = {}, {}, {}
-
-embeddings_folder_path = os.path.join(main_path, 'embeddings')
-if not os.path.exists(embeddings_folder_path):
-    os.mkdir(embeddings_folder_path)
-
-for genre, song_entries in song_entries_by_genre.items():
-    # split data into train, validation and test sets
-    train_data[genre] = song_entries[:int(len(song_entries)*0.7)]
-    validation_data[genre] = song_entries[int(len(song_entries)*0.7):int(len(song_entries)*0.8)]
-    test_data[genre] = song_entries[int(len(song_entries)*0.8):]
-
-    # # print statistics
-    min_length = min([len(song_entry.lyrics) for song_entry in song_entries])
-    max_length = max([len(song_entry.lyrics) for song_entry in song_entries])
-    avg_length = np.mean([len(song_entry.lyrics) for song_entry in song_entries])
-    avg_number_of_unique_words = np.mean([song_entry.number_of_unique_words for song_entry in song_entries])
-    avg_n_words = np.mean([song_entry.number_of_words for song_entry in song_entries])
-    print(f'{genre} - min: {min_length} | n_words: {avg_n_words} | unique_words: {avg_number_of_unique_words} | max: {max_length} | mean: {avg_length} | all: {len(song_entries)} | train: {len(train_data[genre])} | validation: {len(validation_data[genre])} | test: {len(test_data[genre])}')
-
-train_song_entries = sorted([item for value in train_data.values() for item in value], key=lambda song: len(song.lyrics))
-validation_song_entries = sorted([item for value in validation_data.values() for item in value], key=lambda song: len(song.lyrics))
-test_song_entries = sorted([item for value in test_data.values() for item in value], key=lambda song: len(song.lyrics))
-
-n_lines_count = []
-n_words_count = []
-n_chars_count = []
-
-lines_counter = 0
-for song in train_song_entries:
-    song.start_index = lines_counter
-    lines_counter += song.number_of_lines
-    n_lines_count.append(song.number_of_lines)
-    n_words_count.append(song.number_of_words)
-    n_chars_count.append(song.number_of_chars)
-
-lines_counter = 0
-for song in validation_song_entries:
-    song.start_index = lines_counter
-    lines_counter += song.number_of_lines
-    n_lines_count.append(song.number_of_lines)
-    n_words_count.append(song.number_of_words)
-    n_chars_count.append(song.number_of_chars)
-    
-lines_counter = 0
-for song in test_song_entries:
-    song.start_index = lines_counter
-    lines_counter += song.number_of_lines
-    n_lines_count.append(song.number_of_lines)
-    n_words_count.append(song.number_of_words)
-    n_chars_count.append(song.number_of_chars)
-
-n_lines_count = np.asarray(n_lines_count)
-n_words_count = np.asarray(n_words_count)
-n_chars_count = np.asarray(n_chars_count)
-
-print('Average number of lines ', n_lines_count.mean())
-print('Average number of words ', n_words_count.mean())
-print('Average number of chars ', n_chars_count.mean())
-
-data_manager = DataManager(main_path)
-data_manager.save_python_obj(train_song_entries, 'song_lyrics.train')
-data_manager.save_python_obj(validation_song_entries, 'song_lyrics.validation')
-data_manager.save_python_obj(test_song_entries, 'song_lyrics.test')
-
-save_dataset_text(train_song_entries, embeddings_folder_path, 'embeddings.train.txt')
-save_dataset_text(validation_song_entries, embeddings_folder_path, 'embeddings.validation.txt')
-save_dataset_text(test_song_entries, embeddings_folder_path, 'embeddings.test.txt')
\ No newline at end of file
+        songs.append((genre_label, split_of(lyrics), Song(song_genre, lyrics)))
+
+    return songs
+
+
+def imap_bounded(pool: Pool, function, iterable, max_pending: int):
+    """
+    like pool.imap, but only reads the next items of iterable when fewer than max_pending tasks are unfinished,
+    so a streamed input is never loaded completely
+    """
+
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def parse() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--songs_limit', default=13000, type=int, help='max number of songs per genre, 0 for all')
+    parser.add_argument('--chunk_size', default=10000, type=int, help='csv rows per preprocessing task')
+    parser.add_argument('--processes', default=0, type=int, help='number of preprocessing processes, 0 for all cores')
+    parser.add_argument('--spill_songs', default=20000, type=int,
+                        help='songs per split kept in memory before they are sorted and spilled to disk')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ensure_current_directory()
+    arguments = parse()
+    main_path = os.path.join('local_data', 'data')
+
+    dataset_folder_path = os.path.join(main_path, '380000-lyrics-from-metrolyrics')
+    if not os.path.exists(dataset_folder_path):
+        raise Exception('Dataset folder does not exist')
+
+    dataset_file_path = os.path.join(dataset_folder_path, 'lyrics.csv')
+    if not os.path.exists(dataset_file_path):
+        raise Exception('Dataset file does not exist')
+
+    embeddings_folder_path = os.path.join(main_path, 'embeddings')
+    if not os.path.exists(embeddings_folder_path):
+        os.mkdir(embeddings_folder_path)
+
+    statistics_by_genre = {}
+    totals = {'lines': 0, 'words': 0, 'chars': 0, 'songs': 0}
+
+    # sorted runs of the songs of every split are spilled here, so the songs are never all in memory
+    with tempfile.TemporaryDirectory(dir=main_path) as spill_folder_path:
+        sorter_by_split = {split: SongSorter(spill_folder_path, arguments.spill_songs) for split in SPLITS}
+
+        # the csv is streamed in chunks, which are filtered and cleaned up in parallel and come back in file order
+        chunks = pd.read_csv(dataset_file_path, usecols=['genre', 'lyrics'], dtype=str, keep_default_na=False,
+                             chunksize=arguments.chunk_size, encoding='utf8')
+        processes = arguments.processes or os.cpu_count()
+        with Pool(processes) as pool:
+            for songs in imap_bounded(pool, process_chunk, chunks, max_pending=2 * processes):
+                for genre_label, split, song_entry in songs:
+                    statistics = statistics_by_genre.setdefault(genre_label, GenreStatistics())
+                    if 0 < arguments.songs_limit <= statistics.count:
+                        continue
+
+                    statistics.update(song_entry, split)
+                    sorter_by_split[split].add(song_entry)
+
+        for genre_label, statistics in statistics_by_genre.items():
+            print(f'{genre_label} - {statistics}')
+
+        # the metadata, the lyrics blob and the embeddings text are written in one pass over the merged runs
+        for split in SPLITS:
+            write_song_metadata(main_path, split,
+                                numbered_songs(sorter_by_split[split].sorted_songs(),
+                                               os.path.join(embeddings_folder_path, f'embeddings.{split}.txt'),
+                                               totals))
+
+    # no song might pass the filters, e.g. with a csv of other genres
+    number_of_songs = max(totals['songs'], 1)
+    print('Average number of lines ', totals['lines'] / number_of_songs)
+    print('Average number of words ', totals['words'] / number_of_songs)
+    print('Average number of chars ', totals['chars'] / number_of_songs)
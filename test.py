@@ -3,7 +3,7 @@ from utils.constants import *
 from typing import List, Tuple
 from models.enums.Genre import Genre
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 from utils.constants import *
 
@@ -15,15 +15,18 @@ class Tester:
     def __init__(self,
                  model,
                  data_loader_test: DataLoader,
-                 data_loader_sentence,
                  model_state_path='',
                  device='cpu'):
 
         # the saved network as an object
         self.model = model
         self.model_state_path = model_state_path
+        # a loader of a LyricsPairedDataset also yields the aligned sentence batch
         self.data_loader_test = data_loader_test
-        self.data_loader_sentence = data_loader_sentence
+        dataset = data_loader_test.dataset
+        while isinstance(dataset, Subset):
+            dataset = dataset.dataset
+        self.paired = dataset.yields_pairs()
         self.device = device
         self.model.eval()
 
@@ -45,8 +48,9 @@ class Tester:
                    'length_vae': []
                    }
 
-            for i, items in enumerate(zip(self.data_loader_test, self.data_loader_sentence)):
-                (batch, targets, lengths), (batch2, targets2, lengths2) = items
+            for i, items in enumerate(self.data_loader_test):
+                (batch, targets, lengths), (batch2, targets2, lengths2) = items if self.paired \
+                    else (items, (None, None, None))
 
                 accuracy_batch = self._batch_iteration(batch, targets, lengths, log, (batch2, targets2, lengths2), i)
 
@@ -102,6 +106,7 @@ class Tester:
 
         log['final_scores'].append(final_scores_per_class.detach())
         log['length_lstm'].append(lengths.detach())
-        log['length_vae'].append(lengths2.detach())
+        if lengths2 is not None:
+            log['length_vae'].append(lengths2.detach())
 
         return accuracy
@@ -7,16 +7,28 @@ from typing import List, Tuple
 
 import numpy as np
 from tensorboardX import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.optimizer import Optimizer
 from torch.utils.data import DataLoader
 
 from models import GeneralModel
 from utils.constants import *
-from utils.model_utils import save_models, calculate_accuracy
+from utils.dataloader_utils import DataStallTimer
+from utils.distributed_utils import is_distributed, is_main_process, any_process, gradient_sync, set_epoch
+from utils.evaluation_utils import AsyncEvaluator
+from utils.metric_utils import MetricAccumulator
+from utils.precision_utils import autocast, GradientAccumulator
+from utils.model_utils import save_models, calculate_accuracy, inference_mode
 from utils.system_utils import setup_directories, save_codebase_of_run
 
 class Trainer:
 
+    # whether DistributedDataParallel has to look for parameters that get no gradient in a step
+    _find_unused_parameters = False
+
+    # batches between the checks of max_training_minutes in a distributed run, each check all-reduces the clocks
+    _runtime_check_interval = 50
+
     def __init__(self,
                  data_loader_train: DataLoader,
                  data_loader_validation: DataLoader,
@@ -25,13 +37,16 @@ class Trainer:
                  loss_function: GeneralModel,
                  args: argparse.Namespace,
                  patience: int,
-                 device="cpu"):
+                 device="cpu",
+                 data_loader_validation_subset: DataLoader = None):
 
         self.arguments = args
         self.loss_function = loss_function
         self.optimizer = optimizer
         self.model = model
         self.data_loader_validation = data_loader_validation
+        # fixed subset of the validation set for the checks during an epoch, if any
+        self.data_loader_validation_subset = data_loader_validation_subset
         self.data_loader_train = data_loader_train
         self._log_header = '  Time Epoch Iteration    Progress (%Epoch) | Train Loss Train Acc. | Valid Loss Valid Acc. | Best | VAE-stuff'
         self._log_template = ' '.join(
@@ -41,17 +56,57 @@ class Trainer:
         self._device = device
         self._patience = patience
 
+        # real and padded tokens of the current epoch
+        self._real_tokens = 0
+        self._padded_tokens = 0
+
+        # loss and accuracy of every training batch of the current epoch, read back only when logged
+        self._train_metrics = MetricAccumulator(['loss', 'acc'], capacity=len(data_loader_train),
+                                                distributed=is_distributed())
+
+        # the training batches run through the model wrapped in DistributedDataParallel in a distributed run, which
+        # all-reduces the gradients during the backward pass. validation runs on the (same) unwrapped model
+        self._training_model = model
+        if is_distributed():
+            self._training_model = DistributedDataParallel(model, find_unused_parameters=self._find_unused_parameters)
+
+        # optimizer steps over accumulation_steps micro-batches, with loss scaling for float16 autocast
+        self._gradients = GradientAccumulator(optimizer,
+                                              model.parameters(),
+                                              accumulation_steps=args.accumulation_steps,
+                                              loss_scaling=(args.autocast_dtype == 'float16'))
+
+        # time the current epoch waited on data
+        self._data_stall = DataStallTimer()
+        self._epoch_start_time = time.time()
+        self._last_evaluation_time = time.time()
+
+        # background evaluator process, started by train with --async_eval
+        self._evaluator = None
+        self._show_progress = True
+
         # validate input to class
         self._validate_self()
 
         # init current runs timestamp
         DATA_MANAGER.set_date_stamp(addition=args.run_name)
 
-        # initialize tensorboardx
-        self.writer = SummaryWriter(os.path.join(GITIGNORED_DIR, RESULTS_DIR, DATA_MANAGER.stamp, SUMMARY_DIR))
+        # initialize tensorboardx, only the first process of a distributed run logs
+        self.writer = None
+        if is_main_process():
+            self.writer = SummaryWriter(os.path.join(GITIGNORED_DIR, RESULTS_DIR, DATA_MANAGER.stamp, SUMMARY_DIR))
 
         self._start_time = time.time()
 
+    def __getstate__(self):
+        # what the evaluator process needs of the trainer, it gets the model weights through shared memory
+        state = self.__dict__.copy()
+        for name in ['model', 'optimizer', 'writer', 'data_loader_train', '_evaluator', '_train_metrics',
+                     '_gradients', '_training_model']:
+            state[name] = None
+        state['_show_progress'] = False
+        return state
+
     def _validate_self(self):
         pass #todo
 
@@ -61,14 +116,19 @@ class Trainer:
         """
 
         # setup data output directories:
-        setup_directories()
-        save_codebase_of_run(self.arguments)
+        if is_main_process():
+            setup_directories()
+            save_codebase_of_run(self.arguments)
 
-        # data gathering
-        progress = []
+        # data gathering, the loss and accuracy of every training batch
+        progress = np.zeros((0, 2), dtype=np.float32)
 
         epoch = 0
 
+        if self.arguments.async_eval:
+            assert not is_distributed(), 'async_eval is not supported in distributed training'
+            self._evaluator = AsyncEvaluator(self, device=self._device, threads=self.arguments.eval_threads)
+
         try:
 
             print(f"{PRINTCOLOR_BOLD}Started training with the following config:{PRINTCOLOR_END}\n{self.arguments}\n\n")
@@ -78,17 +138,24 @@ class Trainer:
             patience = self._patience
             # run
             for epoch in range(self.arguments.epochs):
+                set_epoch(self.data_loader_train, epoch)
+
                 # do epoch
                 epoch_progress, best_metrics, patience = self._epoch_iteration(epoch, best_metrics, patience)
 
-                # add progress-list to global progress-list
-                progress += epoch_progress
+                # add progress of the epoch to global progress
+                progress = np.concatenate([progress, epoch_progress])
+
+                self._log_padding_efficiency(epoch)
+                self._log_data_stall(epoch)
+                self._log_song_cache(epoch)
 
                 # write progress to pickle file (overwrite because there is no point keeping seperate versions)
-                DATA_MANAGER.save_python_obj(progress,
-                                             os.path.join(RESULTS_DIR, DATA_MANAGER.stamp, PROGRESS_DIR,
-                                                          "progress_list"),
-                                             print_success=False)
+                if is_main_process():
+                    DATA_MANAGER.save_python_obj({"loss": progress[:, 0], "acc": progress[:, 1]},
+                                                 os.path.join(RESULTS_DIR, DATA_MANAGER.stamp, PROGRESS_DIR,
+                                                              "progress_list"),
+                                                 print_success=False)
 
                 # flush prints
                 sys.stdout.flush()
@@ -104,6 +171,13 @@ class Trainer:
             print(e)
             save_models([self.model], f"CRASH_at_epoch_{epoch}")
             raise e
+        finally:
+            # the last evaluation still writes model_best
+            if self._evaluator is not None:
+                self._evaluator.close()
+            # flushes the summaries before a spawned training process exits
+            if self.writer is not None:
+                self.writer.close()
 
         # flush prints
         sys.stdout.flush()
@@ -116,7 +190,7 @@ class Trainer:
         self,
         epoch_num: int,
         best_metrics: Tuple[float, float],
-        patience: int) -> Tuple[List, Tuple, int]:
+        patience: int) -> Tuple[np.ndarray, Tuple, int]:
         """
         one epoch implementation
         """
@@ -124,22 +198,20 @@ class Trainer:
         if not self.arguments.train_classifier:
             self.loss_function.reset()
 
-        progress = []
-
-        train_accuracy = 0
-        train_loss = 0
+        self._train_metrics.reset()
         data_loader_length = len(self.data_loader_train)
+        self._real_tokens, self._padded_tokens = 0, 0
+        self._data_stall.reset()
+        self._epoch_start_time = time.time()
 
-        for i, (batch, targets, lengths) in enumerate(self.data_loader_train):
+        for i, (batch, targets, lengths) in enumerate(self._data_stall.wrap(self.data_loader_train)):
             print(f'Train: {i}/{data_loader_length}       \r', end='')
 
+            self._count_padding(batch, lengths)
+
             # do forward pass and whatnot on batch
             loss_batch, accuracy_batch = self._batch_iteration(batch, targets, lengths, i)
-            train_loss += loss_batch
-            train_accuracy += accuracy_batch
-
-            # add to list somehow:
-            progress.append({"loss": loss_batch, "acc": accuracy_batch})
+            self._train_metrics.add(loss=loss_batch, acc=accuracy_batch)
 
             # calculate amount of batches and walltime passed
             batches_passed = i + (epoch_num * len(self.data_loader_train))
@@ -147,23 +219,21 @@ class Trainer:
 
             # run on validation set and print progress to terminal
             # if we have eval_frequency or if we have finished the epoch
-            if (batches_passed % self.arguments.eval_freq) == 0 or (i + 1 == data_loader_length):
-                loss_validation, acc_validation = self._evaluate()
-
-                new_best = False
-                if self.model.compare_metric(best_metrics, loss_validation, acc_validation):
-                    save_models([self.model], 'model_best')
+            for loss_validation, acc_validation, new_best in self._validations(i + 1 == data_loader_length,
+                                                                               batches_passed,
+                                                                               best_metrics):
+                if new_best:
                     best_metrics = (loss_validation, acc_validation)
-                    new_best = True
                     patience = self._patience
                 else:
                     patience -= 1
 
+                train_metrics = self._train_metrics.means()
                 self._log(
                     loss_validation,
                     acc_validation,
-                    (train_loss / (i + 1)),
-                    (train_accuracy / (i + 1)),
+                    train_metrics['loss'],
+                    train_metrics['acc'],
                     batches_passed,
                     float(time_passed.microseconds),
                     epoch_num,
@@ -172,68 +242,210 @@ class Trainer:
                     new_best)
 
             # check if runtime is expired
-            if (time_passed.total_seconds() > (self.arguments.max_training_minutes * 60)) \
-                    and self.arguments.max_training_minutes > 0:
-                raise KeyboardInterrupt(f"Process killed because {self.arguments.max_training_minutes} minutes passed "
-                                        f"since {DATA_MANAGER.actual_date}. Time now is {datetime.now()}")
+            self._check_runtime(time_passed, batches_passed)
 
             if patience == 0:
                 break
 
-        return progress, best_metrics, patience
+        return self._train_metrics.history(), best_metrics, patience
+
+    def _check_runtime(self, time_passed, batches_passed: int):
+        """
+        stops the training once max_training_minutes passed, in every process of a distributed run at the same batch.
+        a distributed run only checks every _runtime_check_interval batches (batches_passed is the same everywhere)
+        """
+
+        if self.arguments.max_training_minutes <= 0 or \
+                (is_distributed() and batches_passed % self._runtime_check_interval != 0):
+            return
+
+        if any_process(time_passed.total_seconds() > (self.arguments.max_training_minutes * 60)):
+            raise KeyboardInterrupt(f"Process killed because {self.arguments.max_training_minutes} minutes passed "
+                                    f"since {DATA_MANAGER.actual_date}. Time now is {datetime.now()}")
 
     def _batch_iteration(self,
                          batch: torch.Tensor,
                          targets: torch.Tensor,
                          lengths: torch.Tensor,
                          step: int,
-                         train_mode: bool = True) -> Tuple[float, float]:
+                         train_mode: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        runs forward pass on batch and backward pass if in train_mode
+        runs forward pass on batch and backward pass if in train_mode, returns the detached loss and accuracy
         """
 
-        batch = batch.to(self._device)
-        targets = targets.to(self._device)
-        lengths = lengths.to(self._device)
-
         if train_mode:
             self.model.train()
-            self.optimizer.zero_grad()
         else:
             self.model.eval()
 
-        output = self.model.forward(batch, lengths=lengths, step=step, label=targets)
-        loss = self.loss_function.forward(targets, *output)
+        # the last batch of the epoch always steps, so no gradients carry over to the next epoch
+        last = step + 1 == len(self.data_loader_train)
 
-        if train_mode:
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=5.0)
-            self.optimizer.step()
+        # the gradients are only all-reduced over the processes for the micro-batch before an optimizer step
+        with gradient_sync(self._training_model, sync=not train_mode or self._gradients.will_step(last)):
+            loss, accuracy = self._forward(batch, targets, lengths, step)
+
+            if train_mode:
+                self._gradients.backward(loss, last=last)
+
+        return loss.detach(), accuracy
+
+    def _forward(self,
+                 batch: torch.Tensor,
+                 targets: torch.Tensor,
+                 lengths: torch.Tensor,
+                 step: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        moves a batch to the device and returns its loss and accuracy as (device) tensors, the forward pass and the
+        loss run under autocast if a lower precision is set
+        """
+
+        batch = batch.to(self._device)
+        targets = targets.to(self._device)
+        lengths = lengths.to(self._device)
+
+        model = self._training_model if self.model.training else self.model
+
+        with autocast(self._device, self.arguments.autocast_dtype):
+            output = model.forward(batch, lengths=lengths, step=step, label=targets)
+            loss = self.loss_function.forward(targets, *output)
 
-        accuracy = 0
         if self.arguments.train_classifier:
-            accuracy = calculate_accuracy(targets, *output).item()
+            accuracy = calculate_accuracy(targets, *output)
+        else:
+            accuracy = torch.zeros(())
 
-        return loss.item(), accuracy
+        return loss, accuracy
 
-    def _evaluate(self) -> Tuple[float, float]:
+    def _validations(self,
+                     end_of_epoch: bool,
+                     batches_passed: int,
+                     best_metrics: Tuple[float, float]) -> List[Tuple[float, float, bool]]:
         """
-        runs iteration on validation set
+        validates if it is due and returns the (loss, accuracy, new best) results. with the async evaluator the
+        weights are only submitted and the results of earlier submissions are returned once they are ready
         """
 
-        accuracies = []
-        losses = []
-        data_loader_length = len(self.data_loader_validation)
+        due = end_of_epoch or self._evaluation_due(batches_passed)
 
-        for i, (batch, targets, lengths) in enumerate(self.data_loader_validation):
-            print(f'Validation: {i}/{data_loader_length}       \r', end='')
+        if self._evaluator is not None:
+            if not due:
+                return self._evaluator.results()
+            self._last_evaluation_time = time.time()
+            # the full evaluation at the end of an epoch waits for a running one instead of being skipped
+            return self._evaluator.submit(self.model, full=end_of_epoch, wait=end_of_epoch)
 
-            # do forward pass and whatnot on batch
-            loss_batch, accuracy_batch = self._batch_iteration(batch, targets, lengths, i, train_mode=False)
-            accuracies.append(accuracy_batch)
-            losses.append(loss_batch)
+        if not due:
+            return []
+
+        loss_validation, acc_validation = self._evaluate(full=end_of_epoch)
+        new_best = self.model.compare_metric(best_metrics, loss_validation, acc_validation)
+        if new_best:
+            save_models([self.model], 'model_best')
 
-        return float(np.mean(losses)), float(np.mean(accuracies))
+        return [(loss_validation, acc_validation, new_best)]
+
+    def _evaluation_due(self, batches_passed: int) -> bool:
+        """
+        whether to validate during the epoch, every eval_freq batches and/or every eval_seconds of wall-clock time
+        """
+
+        if self.arguments.eval_freq > 0 and (batches_passed % self.arguments.eval_freq) == 0:
+            return True
+
+        # the clocks of the processes of a distributed run differ, they validate as soon as one of them is due
+        return self.arguments.eval_seconds > 0 and \
+            any_process(self.arguments.eval_seconds <= time.time() - self._last_evaluation_time)
+
+    def _validation_loader(self, full: bool) -> DataLoader:
+        """
+        the full validation loader, or the subset loader for checks during the epoch if there is one
+        """
+
+        if full or self.data_loader_validation_subset is None:
+            return self.data_loader_validation
+        return self.data_loader_validation_subset
+
+    def _evaluate(self, full: bool = True) -> Tuple[float, float]:
+        """
+        runs iteration on validation set (or its subset) without autograd, the batch results stay on the device
+        until the end
+        """
+
+        data_loader = self._validation_loader(full)
+        data_loader_length = len(data_loader)
+        metrics = MetricAccumulator(['loss', 'acc'], distributed=is_distributed())
+
+        self.model.eval()
+        with inference_mode():
+            for i, (batch, targets, lengths) in enumerate(self._data_stall.wrap(data_loader)):
+                if self._show_progress:
+                    print(f'Validation: {i}/{data_loader_length}       \r', end='')
+
+                # do forward pass and whatnot on batch
+                loss_batch, accuracy_batch = self._forward(batch, targets, lengths, i)
+                metrics.add(loss=loss_batch, acc=accuracy_batch)
+
+        self._last_evaluation_time = time.time()
+
+        means = metrics.means()
+        return means['loss'], means['acc']
+
+    def _count_padding(self, batch: torch.Tensor, lengths: torch.Tensor):
+        """
+        adds the real tokens and the padded size of a (not yet moved) batch to the counts of the epoch
+        """
+
+        self._real_tokens += int(lengths.sum())
+        self._padded_tokens += batch.shape[0] * batch.shape[1]
+
+    def _log_padding_efficiency(self, epoch: int):
+        """
+        logs the share of real tokens (lines for embeddings, words for raw lyrics) in the padded batches of an epoch
+        """
+
+        if self._padded_tokens == 0 or self.writer is None:
+            return
+
+        padding_efficiency = self._real_tokens / self._padded_tokens
+        print(f"Padding efficiency epoch {epoch}: {padding_efficiency:.3f} "
+              f"({self._real_tokens} real / {self._padded_tokens} padded tokens)")
+        self.writer.add_scalar("Padding_efficiency", padding_efficiency, epoch)
+
+    def _log_data_stall(self, epoch: int):
+        """
+        logs how long the training and validation loops of an epoch waited on their DataLoaders
+        """
+
+        if self.writer is None:
+            return
+
+        epoch_time = time.time() - self._epoch_start_time
+        print(f"Data stall epoch {epoch}: {self._data_stall.waiting_time:.1f}s waiting on {self._data_stall.batches} "
+              f"batches ({100. * self._data_stall.waiting_time / max(epoch_time, 1e-8):.1f}% of {epoch_time:.1f}s)")
+        self.writer.add_scalar("Data_stall_seconds", self._data_stall.waiting_time, epoch)
+
+    def _log_song_cache(self, epoch: int):
+        """
+        logs the hits, misses and evictions of the song caches of the training and validation data during an epoch
+        """
+
+        if self.writer is None:
+            return
+
+        for name, data_loader in [("train", self.data_loader_train), ("validation", self.data_loader_validation)]:
+            cache = getattr(data_loader.dataset, 'cache', None)
+            if cache is None:
+                continue
+
+            stats = cache.stats()
+            print(f"Song cache {name} epoch {epoch}: {stats['hits']} hits, {stats['misses']} misses, "
+                  f"{stats['evictions']} evictions, hit rate {stats['hit_rate']:.3f}")
+            self.writer.add_scalar(f"Song_cache_hit_rate_{name}", stats['hit_rate'], epoch)
+            self.writer.add_scalar(f"Song_cache_evictions_{name}", stats['evictions'], epoch)
+
+            # the counts of every epoch start from zero
+            cache.reset_stats()
 
     def _log(self,
              loss_validation: float,
@@ -249,6 +461,10 @@ class Trainer:
         """
         logs progress to user through tensorboard and terminal
         """
+
+        if self.writer is None:
+            return
+
         if self.arguments.train_classifier:
             self.writer.add_scalar("Accuracy_validation", acc_validation, batches_done, time_passed)
             self.writer.add_scalar("Accuracy_train", acc_train, batches_done, time_passed)
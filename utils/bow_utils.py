@@ -0,0 +1,76 @@
+import zlib
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils.tokenization_utils import tokenize_lyrics
+
+_BOW_CHUNK_SIZE = 20000
+
+
+def hash_words(words: np.ndarray, number_of_features: int) -> np.ndarray:
+    """ maps words to one of number_of_features columns with crc32, which is the same in every process and run """
+
+    return np.asarray([zlib.crc32(word.encode('utf-8')) % number_of_features for word in words], dtype=np.int64)
+
+
+def _encode_chunk(tokenized_texts: List[List[str]], vocabulary: Dict[str, int], grow_vocabulary: bool,
+                  number_of_features: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    returns the non-zeros per text, the sorted columns and the word counts of the texts of one chunk.
+    words are looked up once per distinct word of the chunk (in order of appearance) instead of once per occurrence
+    """
+
+    # an object array keeps the words as they are, a str array would pad all of them to the longest word
+    words = np.fromiter((word for words in tokenized_texts for word in words), dtype=object,
+                        count=sum([len(words) for words in tokenized_texts]))
+    texts = np.repeat(np.arange(len(tokenized_texts), dtype=np.int64), [len(words) for words in tokenized_texts])
+
+    inverse, unique_words = pd.factorize(words)
+    if number_of_features > 0:
+        unique_columns = hash_words(unique_words, number_of_features)
+    elif grow_vocabulary:
+        unique_columns = np.asarray([vocabulary.setdefault(word, len(vocabulary)) for word in unique_words],
+                                    dtype=np.int64)
+    else:
+        unique_columns = np.asarray([vocabulary.get(word, -1) for word in unique_words], dtype=np.int64)
+
+    # words outside of the vocabulary are left out
+    columns = unique_columns[inverse]
+    known = columns >= 0
+
+    # one key per (text, column) pair, counting the keys gives the sparse rows sorted by text and column
+    keys, counts = np.unique((texts[known] << 32) | columns[known], return_counts=True)
+    non_zeros = np.bincount(keys >> 32, minlength=len(tokenized_texts))
+
+    return non_zeros, keys & 0xffffffff, counts
+
+
+def build_bow_matrix(texts: List[str], vocabulary: Dict[str, int] = None, grow_vocabulary: bool = False,
+                     number_of_features: int = 0, processes: int = None):
+    """
+    tokenizes lowercased texts chunk by chunk and encodes them as a CSR bag-of-words matrix.
+    columns come from the vocabulary (which is extended with new words if grow_vocabulary) or,
+    with number_of_features > 0, from hashing the words. returns the indptr, indices and counts of the matrix
+    and the number of tokens of every text
+    """
+
+    vocabulary = {} if vocabulary is None else vocabulary
+    non_zeros, indices, values, lengths = [], [], [], []
+
+    for start in range(0, len(texts), _BOW_CHUNK_SIZE):
+        tokenized_texts = tokenize_lyrics([text.lower() for text in texts[start:start + _BOW_CHUNK_SIZE]], processes)
+        chunk_non_zeros, chunk_indices, chunk_values = _encode_chunk(tokenized_texts, vocabulary, grow_vocabulary,
+                                                                     number_of_features)
+        non_zeros.append(chunk_non_zeros)
+        indices.append(chunk_indices)
+        values.append(chunk_values)
+        lengths.append(np.asarray([len(words) for words in tokenized_texts], dtype=np.int64))
+
+    indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+    if texts:
+        indptr[1:] = np.cumsum(np.concatenate(non_zeros))
+        return indptr, np.concatenate(indices), np.concatenate(values).astype(np.float32), np.concatenate(lengths)
+
+    return indptr, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
@@ -0,0 +1,79 @@
+import multiprocessing
+from collections import OrderedDict
+
+import torch
+
+_HITS, _MISSES, _EVICTIONS = 0, 1, 2
+
+
+class SongTensorCache:
+    """
+    LRU cache of decoded song tensors keyed by song index, that evicts the least recently used songs once the
+    cached tensors take more than max_bytes. every process (DataLoader worker) has its own entries, but the
+    hit/miss/eviction counters live in shared memory, updated under a lock, so the main process sees the counts of
+    all workers
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # a lock of the spawn context can be shared with forked DataLoader workers as well as with spawned processes,
+        # like the --async_eval evaluator that gets the validation dataset pickled
+        self._counters = multiprocessing.get_context('spawn').Array('q', 3)
+
+    def __getstate__(self):
+        # the entries belong to a process, a new process starts with an empty cache but shares the counters
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        state['_bytes'] = 0
+        return state
+
+    def get(self, key):
+        """ returns the cached tensor of key, or None when it isn't cached """
+
+        tensor = self._entries.get(key, None)
+        if tensor is None:
+            self._count(_MISSES)
+            return None
+
+        self._entries.move_to_end(key)
+        self._count(_HITS)
+        return tensor
+
+    def put(self, key, tensor: torch.Tensor):
+        """ caches tensor under key and evicts the least recently used tensors that don't fit anymore """
+
+        size = tensor.element_size() * tensor.nelement()
+        if size > self.max_bytes or key in self._entries:
+            return
+
+        self._entries[key] = tensor
+        self._bytes += size
+
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.element_size() * evicted.nelement()
+            self._count(_EVICTIONS)
+
+    def _count(self, counter: int):
+        # += on the shared counter is a read and a write, workers could otherwise lose each other's updates
+        with self._counters.get_lock():
+            self._counters[counter] += 1
+
+    def stats(self) -> dict:
+        """ counters of all processes, entries and bytes of the current process """
+
+        with self._counters.get_lock():
+            hits, misses, evictions = self._counters[:]
+        return {'hits': hits,
+                'misses': misses,
+                'evictions': evictions,
+                'hit_rate': hits / max(hits + misses, 1),
+                'entries': len(self._entries),
+                'megabytes': self._bytes / 2 ** 20}
+
+    def reset_stats(self):
+        with self._counters.get_lock():
+            self._counters[:] = [0, 0, 0]
@@ -1,8 +1,14 @@
+import random
+import time
+
 import numpy as np
 
 import torch
+from torch.utils.data import get_worker_info
 from collections import Counter, OrderedDict
 
+from utils.hdf5_utils import close_hdf5_files
+
 class OrderedCounter(Counter, OrderedDict):
     'Counter that remembers the order elements are first encountered'
 
@@ -12,35 +18,214 @@ class OrderedCounter(Counter, OrderedDict):
     def __reduce__(self):
         return self.__class__, (OrderedDict(self),)
 
+
+class PaddedBatchCollator:
+    """
+    collate function for (sequence, target) pairs, pads the sequences straight into a [batch, max_length, dimension]
+    tensor of the wanted dtype, sorted from longest to shortest so it can be used by pack_padded_sequence(...).
+    with number_of_buffers > 0 the padded tensors are views on a pool of reused buffers instead of new allocations
+    """
+
+    def __init__(self, dtype: torch.dtype = torch.float32, pad_value: float = 0.0, number_of_buffers: int = 0):
+        self.dtype = dtype
+        self.pad_value = pad_value
+        self.number_of_buffers = number_of_buffers
+
+        self._buffers = [torch.empty(0, dtype=dtype) for _ in range(number_of_buffers)]
+        self._next_buffer = 0
+
+    def __getstate__(self):
+        # buffers are not shipped to DataLoader workers, they don't use them anyway
+        state = self.__dict__.copy()
+        state['_buffers'] = [torch.empty(0, dtype=self.dtype) for _ in range(self.number_of_buffers)]
+        return state
+
+    def __call__(self, DataLoaderBatch):
+        batch_split = list(zip(*DataLoaderBatch))
+        sequences, targets = batch_split[0], batch_split[1]
+
+        # stable, so a batch that is already sorted keeps its order
+        lengths = np.asarray([len(sequence) for sequence in sequences])
+        perm_idx = torch.from_numpy(np.argsort(-lengths, kind='stable'))
+        lengths = torch.from_numpy(lengths)[perm_idx]
+
+        max_length = int(lengths[0])
+        embedding_dimension = sequences[0].shape[1]
+
+        padded_sequences = self._allocate((len(sequences), max_length, embedding_dimension))
+
+        # copy every sequence straight to its sorted position, casting to the output dtype on the way
+        for i, (index, length) in enumerate(zip(perm_idx.tolist(), lengths.tolist())):
+            padded_sequences[i, :length] = torch.as_tensor(sequences[index])
+            padded_sequences[i, length:] = self.pad_value
+
+        return padded_sequences, torch.tensor(targets)[perm_idx], lengths
+
+    def _allocate(self, shape) -> torch.Tensor:
+        """ returns an uninitialized tensor of shape, taken from the buffer pool when possible """
+
+        # tensors of worker processes are moved to shared memory, reusing them there would overwrite batches in use
+        if self.number_of_buffers == 0 or get_worker_info() is not None:
+            return torch.empty(shape, dtype=self.dtype)
+
+        size = int(np.prod(shape))
+        buffer = self._buffers[self._next_buffer]
+        if buffer.numel() < size:
+            buffer = torch.empty(size, dtype=self.dtype)
+            self._buffers[self._next_buffer] = buffer
+        self._next_buffer = (self._next_buffer + 1) % self.number_of_buffers
+
+        return buffer[:size].view(shape)
+
+
+_default_collator = PaddedBatchCollator()
+
+
+class TokenBatchCollator:
+    """
+    collate function for the (input, target, length) token-id sequences of the LyricsRawDataset,
+    pads inputs and targets with pad_idx to the longest sequence of the batch and returns the lengths as a tensor
+    for pack_padded_sequence(...). with sort=True the batch is ordered from longest to shortest
+    """
+
+    def __init__(self, pad_idx: int, sort: bool = False):
+        self.pad_idx = pad_idx
+        self.sort = sort
+
+    def __call__(self, DataLoaderBatch):
+        inputs, targets, lengths = zip(*DataLoaderBatch)
+
+        lengths = torch.tensor(lengths, dtype=torch.long)
+        if self.sort:
+            lengths, order = lengths.sort(0, descending=True)
+        else:
+            order = torch.arange(len(lengths))
+
+        max_length = int(lengths.max())
+        padded_inputs = torch.full((len(inputs), max_length), self.pad_idx, dtype=torch.long)
+        padded_targets = torch.full((len(targets), max_length), self.pad_idx, dtype=torch.long)
+        for i, (index, length) in enumerate(zip(order.tolist(), lengths.tolist())):
+            padded_inputs[i, :length] = torch.from_numpy(inputs[index])
+            padded_targets[i, :length] = torch.from_numpy(targets[index])
+
+        return padded_inputs, padded_targets, lengths
+
+
+class SparseBatchCollator:
+    """
+    collate function for the (columns, counts, label, length) bag-of-words rows of the BOWDataloader,
+    returns the rows as a sparse [batch, number_of_features] tensor, or densified if dense
+    """
+
+    def __init__(self, number_of_features: int, dense: bool = True):
+        self.number_of_features = number_of_features
+        self.dense = dense
+
+    def __call__(self, DataLoaderBatch):
+        columns, counts, labels, lengths = zip(*DataLoaderBatch)
+
+        rows = np.repeat(np.arange(len(columns)), [len(row_columns) for row_columns in columns])
+        indices = torch.from_numpy(np.stack([rows, np.concatenate(columns)]))
+        batch = torch.sparse_coo_tensor(indices, torch.from_numpy(np.concatenate(counts)),
+                                        (len(columns), self.number_of_features))
+
+        if self.dense:
+            batch = batch.to_dense()
+
+        return batch, torch.tensor(labels), torch.tensor(lengths)
+
+
 def pad_and_sort_batch(DataLoaderBatch):
     """
     DataLoaderBatch should be a list of (sequence, target, length) tuples...
-    Returns a padded tensor of sequences sorted from longest to shortest, 
+    Returns a padded float32 tensor of sequences sorted from longest to shortest, 
     """
-    batch_size = len(DataLoaderBatch)
-    batch_split = list(zip(*DataLoaderBatch))
+    return _default_collator(DataLoaderBatch)
 
-    sequences, targets = batch_split[0], batch_split[1]
-    
-    lengths = [len(sequence) for sequence in sequences]
-    max_length = max(lengths)
 
-    embedding_dimension = sequences[0].shape[1]
+def init_worker(worker_id: int):
+    """
+    worker_init_fn of the DataLoaders, seeds numpy and random differently per worker and makes the worker open
+    its own file handles instead of using the ones inherited from the main process
+    """
 
-    padded_sequences = np.ones((batch_size, max_length, embedding_dimension))
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
 
-    for i, l in enumerate(lengths):
-        padded_sequences[i][0:l][:] = sequences[i][0:l][:]
-    
-    return _sort_batch(torch.from_numpy(padded_sequences), torch.tensor(targets), torch.tensor(lengths))
+    close_hdf5_files()
 
-def _sort_batch(batch, targets, lengths):
+
+def get_loader_settings(arguments) -> dict:
     """
-    Sort a minibatch by the length of the sequences with the longest sequences first
-    return the sorted batch targes and sequence lengths.
-    This way the output can be used by pack_padded_sequences(...)
+    returns the multi-process loading keyword arguments of a DataLoader
     """
-    seq_lengths, perm_idx = lengths.sort(0, descending=True)
-    seq_tensor = batch[perm_idx]
-    target_tensor = targets[perm_idx]
-    return seq_tensor, target_tensor, seq_lengths
\ No newline at end of file
+
+    settings = {'num_workers': arguments.num_workers,
+                'worker_init_fn': init_worker}
+
+    if arguments.num_workers > 0:
+        settings['prefetch_factor'] = arguments.prefetch_factor
+        settings['persistent_workers'] = arguments.persistent_workers
+
+    return settings
+
+
+class DataStallTimer:
+    """
+    keeps track of how long a training loop waits for the batches of the iterables it wraps
+    """
+
+    def __init__(self):
+        self.waiting_time = 0.0
+        self.batches = 0
+
+    def reset(self):
+        self.waiting_time = 0.0
+        self.batches = 0
+
+    def wrap(self, iterable):
+        """ yields the items of iterable, adding the time spent in fetching them to the waiting time """
+
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.waiting_time += time.time() - start
+            self.batches += 1
+
+            yield item
+
+
+def _benchmark_collate(batch_size=64, embedding_size=256, iterations=200):
+    """ compares the old float64 collate (plus the .float() of the models) against the float32 and buffered collate """
+
+    def float64_pad_and_sort_batch(DataLoaderBatch):
+        sequences, targets = list(zip(*DataLoaderBatch))[:2]
+        lengths = [len(sequence) for sequence in sequences]
+        padded_sequences = np.ones((len(sequences), max(lengths), sequences[0].shape[1]))
+        for i, l in enumerate(lengths):
+            padded_sequences[i][0:l][:] = sequences[i][0:l][:]
+        lengths, perm_idx = torch.tensor(lengths).sort(0, descending=True)
+        return torch.from_numpy(padded_sequences)[perm_idx].float(), torch.tensor(targets)[perm_idx], lengths
+
+    batches = [[(torch.randn(np.random.randint(5, 80), embedding_size), np.random.randint(5))
+                for _ in range(batch_size)] for _ in range(10)]
+
+    collate_functions = [('float64 + .float()', float64_pad_and_sort_batch),
+                         ('float32', PaddedBatchCollator()),
+                         ('float32, 2 buffers', PaddedBatchCollator(number_of_buffers=2)),
+                         ('bfloat16, 2 buffers', PaddedBatchCollator(dtype=torch.bfloat16, number_of_buffers=2))]
+
+    for name, collate_function in collate_functions:
+        start = time.time()
+        for iteration in range(iterations):
+            padded_sequences, _, _ = collate_function(batches[iteration % len(batches)])
+        print(f'{name:>20s}: {1000 * (time.time() - start) / iterations:8.3f} ms/batch')
+
+
+if __name__ == '__main__':
+    _benchmark_collate()
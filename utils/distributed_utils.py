@@ -0,0 +1,114 @@
+import argparse
+import contextlib
+import os
+import sys
+from typing import Callable
+
+import torch
+import torch.distributed as distributed
+import torch.multiprocessing as multiprocessing
+from torch.utils.data import DataLoader
+
+
+def is_distributed() -> bool:
+    return distributed.is_available() and distributed.is_initialized()
+
+
+def get_rank() -> int:
+    return distributed.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return distributed.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank() -> int:
+    """ rank of the process among the processes of its node """
+
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process() -> bool:
+    """ whether this process writes the checkpoints and logs, the first one of a distributed run """
+
+    return get_rank() == 0
+
+
+def launch_world_size(arguments: argparse.Namespace) -> int:
+    return arguments.nodes * arguments.processes_per_node
+
+
+def _run_process(local_rank: int, function: Callable, arguments: argparse.Namespace):
+    """
+    entry of every process started by launch, joins the gloo process group before running the function
+    """
+
+    rank = arguments.node_rank * arguments.processes_per_node + local_rank
+    os.environ['LOCAL_RANK'] = str(local_rank)
+
+    distributed.init_process_group('gloo',
+                                   init_method=f'tcp://{arguments.master_addr}:{arguments.master_port}',
+                                   rank=rank,
+                                   world_size=launch_world_size(arguments))
+
+    # the cores of the node are split between its processes
+    torch.set_num_threads(max(1, torch.get_num_threads() // arguments.processes_per_node))
+
+    # only the first process prints, like it is the only one that writes logs
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+
+    try:
+        function(arguments)
+    finally:
+        distributed.destroy_process_group()
+
+
+def launch(function: Callable, arguments: argparse.Namespace):
+    """
+    runs function(arguments) in processes_per_node processes on this node, which form one process group with the
+    processes that the other nodes (node_rank 1 to nodes - 1) launch with the same master_addr and master_port
+    """
+
+    multiprocessing.spawn(_run_process, args=(function, arguments), nprocs=arguments.processes_per_node, join=True)
+
+
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """ mean of a tensor over all processes, the tensor itself if the run is not distributed """
+
+    if not is_distributed():
+        return tensor
+
+    tensor = tensor.clone()
+    distributed.all_reduce(tensor, op=distributed.ReduceOp.SUM)
+    return tensor / get_world_size()
+
+
+def any_process(flag: bool) -> bool:
+    """ whether the flag is set on any process, so decisions based on wall-clock time are taken by all of them """
+
+    if not is_distributed():
+        return flag
+
+    flag = torch.tensor([int(flag)])
+    distributed.all_reduce(flag, op=distributed.ReduceOp.MAX)
+    return bool(flag.item())
+
+
+def gradient_sync(model: torch.nn.Module, sync: bool):
+    """
+    context of a forward and backward pass, without sync a DistributedDataParallel model only accumulates the
+    gradients locally instead of all-reducing them
+    """
+
+    if sync or not hasattr(model, 'no_sync'):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def set_epoch(data_loader: DataLoader, epoch: int):
+    """ reshuffles the distributed sampler of a loader for a new epoch, the same way on every process """
+
+    for sampler in [data_loader.sampler, data_loader.batch_sampler]:
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
@@ -0,0 +1,383 @@
+import hashlib
+import os
+from multiprocessing import Pool
+from typing import List
+
+import h5py
+import numpy as np
+
+from utils.data_manager import DataManager
+from utils.song_metadata import SongMetadata
+from utils.system_utils import atomic_path
+
+PACKED_EMBEDDINGS_DATASET = 'embeddings'
+PACKED_OFFSETS_DATASET = 'offsets'
+PACKED_MISSING_DATASET = 'missing_lines'
+PACKED_SCALES_DATASET = 'scales'
+PACKED_LINE_IDS_DATASET = 'line_ids'
+
+# storage encodings of the packed embeddings, int8 is stored as uint8 with a per-row scale and offset
+FLOAT32_ENCODING = 'float32'
+FLOAT16_ENCODING = 'float16'
+INT8_ENCODING = 'int8'
+ENCODINGS = [FLOAT32_ENCODING, FLOAT16_ENCODING, INT8_ENCODING]
+
+# amount of lines that are gathered in memory before they are written to the packed file
+_PACKING_BLOCK_SIZE = 4096
+
+# amount of lines that are checked by one validation task
+_VALIDATION_CHUNK_SIZE = 50000
+
+
+def embeddings_file_path(folder: str, set_name: str) -> str:
+    """ path of the original per-line ELMo embeddings file """
+
+    return os.path.join(folder, 'embeddings', f'embeddings.{set_name}.hdf5')
+
+
+def _encoding_suffix(encoding: str) -> str:
+    assert encoding in ENCODINGS, f'Unknown embedding encoding {encoding}'
+    return '' if encoding == FLOAT32_ENCODING else f'.{encoding}'
+
+
+def _dedup_suffix(dedup: bool) -> str:
+    return '.dedup' if dedup else ''
+
+
+def packed_embeddings_file_path(folder: str, set_name: str, encoding: str = FLOAT32_ENCODING,
+                                dedup: bool = False) -> str:
+    """ path of the packed, contiguous embeddings file """
+
+    return os.path.join(folder, 'embeddings',
+                        f'embeddings.{set_name}.packed{_encoding_suffix(encoding)}{_dedup_suffix(dedup)}.hdf5')
+
+
+def memmap_embeddings_file_path(folder: str, set_name: str, encoding: str = FLOAT32_ENCODING,
+                                dedup: bool = False) -> str:
+    """ path of the raw .npy embeddings matrix that is memory-mapped """
+
+    return os.path.join(folder, 'embeddings',
+                        f'embeddings.{set_name}{_encoding_suffix(encoding)}{_dedup_suffix(dedup)}.npy')
+
+
+def memmap_scales_file_path(folder: str, set_name: str, encoding: str = INT8_ENCODING, dedup: bool = False) -> str:
+    """ path of the [rows, 2] scales and offsets of a quantized raw .npy embeddings matrix """
+
+    return os.path.join(folder, 'embeddings',
+                        f'embeddings.{set_name}{_encoding_suffix(encoding)}{_dedup_suffix(dedup)}.scales.npy')
+
+
+def memmap_line_ids_file_path(folder: str, set_name: str) -> str:
+    """ path of the unique row of every line that belongs to the deduplicated raw .npy embeddings matrices """
+
+    return os.path.join(folder, 'embeddings', f'embeddings.{set_name}.line_ids.npy')
+
+
+def memmap_missing_lines_file_path(folder: str, set_name: str) -> str:
+    """ path of the missing lines that belong to the raw .npy embeddings matrix """
+
+    return os.path.join(folder, 'embeddings', f'embeddings.{set_name}.missing.npy')
+
+
+def song_offsets(songs: SongMetadata) -> np.ndarray:
+    """
+    builds the offsets index of the packed embeddings, song i lives in rows offsets[i]:offsets[i+1]
+    """
+
+    offsets = np.zeros(len(songs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(songs.number_of_lines)
+
+    misplaced = np.flatnonzero(songs.start_index != offsets[:-1])
+    if len(misplaced) > 0:
+        i = misplaced[0]
+        raise ValueError(f'Song {i} starts at line {songs.start_index[i]} but line {offsets[i]} was expected, '
+                         f'the songs are not stored contiguously')
+
+    return offsets
+
+
+def pack_embeddings(folder: str, set_name: str, songs: SongMetadata, embedding_size: int = None) -> str:
+    """
+    converts the per-line embeddings file of a set into one contiguous [total_lines, embedding_size] array,
+    stored together with the offsets index of every song and the lines that were missing in the original
+    """
+
+    offsets = song_offsets(songs)
+    total_lines = int(offsets[-1])
+
+    source_path = embeddings_file_path(folder, set_name)
+    target_path = packed_embeddings_file_path(folder, set_name)
+
+    missing_lines = []
+    # the packed file only appears once it is complete, datasets that find it use it without further checks
+    with atomic_path(target_path) as temporary_path, \
+            h5py.File(source_path, 'r') as source_file, h5py.File(temporary_path, 'w') as target_file:
+
+        if embedding_size is None:
+            embedding_size = np.asarray(source_file[next(iter(source_file.keys()))]).size
+
+        # no chunking, so a song is always a single contiguous read
+        embeddings = target_file.create_dataset(PACKED_EMBEDDINGS_DATASET,
+                                                shape=(total_lines, embedding_size),
+                                                dtype=np.float32)
+
+        block = np.zeros((_PACKING_BLOCK_SIZE, embedding_size), dtype=np.float32)
+        for block_start in range(0, total_lines, _PACKING_BLOCK_SIZE):
+            block_end = min(block_start + _PACKING_BLOCK_SIZE, total_lines)
+            print(f'Packing {set_name}: {block_start}/{total_lines}       \r', end='')
+
+            block[:] = 0
+            for line in range(block_start, block_end):
+                key = str(line)
+                if key in source_file:
+                    block[line - block_start] = np.asarray(source_file[key]).reshape(embedding_size)
+                else:
+                    missing_lines.append(line)
+
+            embeddings[block_start:block_end] = block[:block_end - block_start]
+
+        target_file.create_dataset(PACKED_OFFSETS_DATASET, data=offsets)
+        target_file.create_dataset(PACKED_MISSING_DATASET, data=np.asarray(missing_lines, dtype=np.int64))
+
+    print(f'Packed {total_lines} lines of {len(songs)} songs into {target_path} '
+          f'({len(missing_lines)} lines missing)')
+
+    return target_path
+
+
+def dedup_embeddings(folder: str, set_name: str) -> dict:
+    """
+    writes the float32 packed embeddings of a set with every distinct row stored once, together with the unique row
+    of every line, so repeated lines (choruses) are stored and read once. returns the dedup report
+    """
+
+    source_path = packed_embeddings_file_path(folder, set_name)
+    target_path = packed_embeddings_file_path(folder, set_name, dedup=True)
+
+    with atomic_path(target_path) as temporary_path, \
+            h5py.File(source_path, 'r') as source_file, h5py.File(temporary_path, 'w') as target_file:
+        source = source_file[PACKED_EMBEDDINGS_DATASET]
+        total_lines, embedding_size = source.shape
+
+        # first pass: identical rows (identical lines) get the same id, in order of their first line
+        line_ids = np.zeros(total_lines, dtype=np.int64)
+        unique_ids = {}
+        first_lines = []
+        for block_start in range(0, total_lines, _PACKING_BLOCK_SIZE):
+            print(f'Deduplicating {set_name}: {block_start}/{total_lines}       \r', end='')
+            block = source[block_start:min(block_start + _PACKING_BLOCK_SIZE, total_lines)]
+            for line, row in enumerate(block, start=block_start):
+                line_id = unique_ids.setdefault(hashlib.blake2b(row.tobytes(), digest_size=16).digest(),
+                                                len(unique_ids))
+                if line_id == len(first_lines):
+                    first_lines.append(line)
+                line_ids[line] = line_id
+        first_lines = np.asarray(first_lines, dtype=np.int64)
+
+        # second pass: copy the first occurrence of every unique row, which keeps reading the source sequentially
+        embeddings = target_file.create_dataset(PACKED_EMBEDDINGS_DATASET,
+                                                shape=(len(first_lines), embedding_size),
+                                                dtype=np.float32)
+        for block_start in range(0, total_lines, _PACKING_BLOCK_SIZE):
+            block_end = min(block_start + _PACKING_BLOCK_SIZE, total_lines)
+            unique_start, unique_end = np.searchsorted(first_lines, [block_start, block_end])
+            if unique_end > unique_start:
+                block = source[block_start:block_end]
+                embeddings[unique_start:unique_end] = block[first_lines[unique_start:unique_end] - block_start]
+
+        target_file.create_dataset(PACKED_LINE_IDS_DATASET, data=line_ids)
+        target_file.create_dataset(PACKED_OFFSETS_DATASET, data=np.asarray(source_file[PACKED_OFFSETS_DATASET]))
+        target_file.create_dataset(PACKED_MISSING_DATASET, data=np.asarray(source_file[PACKED_MISSING_DATASET]))
+
+    report = {'total_lines': total_lines,
+              'unique_lines': len(first_lines),
+              'bytes_before': os.path.getsize(source_path),
+              'bytes_after': os.path.getsize(target_path)}
+    report['bytes_saved'] = report['bytes_before'] - report['bytes_after']
+
+    print(f'Deduplicated packed embeddings of {set_name} in {target_path}: '
+          f'{report["unique_lines"]}/{total_lines} unique lines '
+          f'({report["unique_lines"] / max(total_lines, 1):.1%}), '
+          f'{report["bytes_before"] / 2 ** 20:.1f} MB -> {report["bytes_after"] / 2 ** 20:.1f} MB '
+          f'({report["bytes_saved"] / 2 ** 20:.1f} MB saved)')
+
+    return report
+
+
+def _find_missing_lines_in_range(job) -> List[int]:
+    """ validation task, returns the lines in [start, end) that have no embeddings """
+
+    path, start, end = job
+    with h5py.File(path, 'r') as embeddings_file:
+        return [line for line in range(start, end) if str(line) not in embeddings_file]
+
+
+def find_missing_lines(path: str, total_lines: int, processes: int = None) -> np.ndarray:
+    """
+    scans the per-line embeddings file in parallel for lines [0, total_lines) without embeddings
+    """
+
+    jobs = [(path, start, min(start + _VALIDATION_CHUNK_SIZE, total_lines))
+            for start in range(0, total_lines, _VALIDATION_CHUNK_SIZE)]
+
+    with Pool(processes) as pool:
+        missing_lines = [line for chunk in pool.map(_find_missing_lines_in_range, jobs) for line in chunk]
+
+    return np.asarray(missing_lines, dtype=np.int64)
+
+
+def load_missing_lines(path: str, total_lines: int) -> np.ndarray:
+    """
+    returns the lines without embeddings of a per-line embeddings file. the result of the scan is cached next to the
+    file and only redone when the file changed or when lines beyond the scanned range are needed
+    """
+
+    folder, file_name = os.path.split(path)
+    data_manager = DataManager(folder)
+    cache_name = f'{file_name}.missing_lines'
+    file_stats = os.stat(path)
+    fingerprint = (file_stats.st_size, file_stats.st_mtime_ns)
+
+    if os.path.exists(os.path.join(folder, f'{cache_name}.pickle')):
+        cache = data_manager.load_python_obj(cache_name)
+        if cache['fingerprint'] == fingerprint and cache['scanned_lines'] >= total_lines:
+            return cache['missing_lines']
+
+    print(f'Validating {total_lines} lines of {path}')
+    missing_lines = find_missing_lines(path, total_lines)
+    print(f'Found {len(missing_lines)} missing lines in {path}')
+
+    data_manager.save_python_obj({'fingerprint': fingerprint,
+                                  'scanned_lines': total_lines,
+                                  'missing_lines': missing_lines}, cache_name)
+
+    return missing_lines
+
+
+def encode_block(block: np.ndarray, encoding: str):
+    """
+    encodes a float32 block of rows, returns the encoded rows and (for int8) their [rows, 2] scales and offsets
+    """
+
+    if encoding == FLOAT32_ENCODING:
+        return block.astype(np.float32), None
+    if encoding == FLOAT16_ENCODING:
+        return block.astype(np.float16), None
+
+    minimum = block.min(axis=1)
+    scale = (block.max(axis=1) - minimum) / 255
+    scale[scale == 0] = 1
+    encoded = np.rint((block - minimum[:, None]) / scale[:, None]).astype(np.uint8)
+
+    return encoded, np.stack([scale, minimum], axis=1).astype(np.float32)
+
+
+def encode_embeddings(folder: str, set_name: str, encoding: str, dedup: bool = False) -> str:
+    """
+    writes the float32 (deduplicated) packed embeddings of a set to a packed file with a reduced precision encoding
+    """
+
+    source_path = packed_embeddings_file_path(folder, set_name, dedup=dedup)
+    target_path = packed_embeddings_file_path(folder, set_name, encoding, dedup)
+
+    with atomic_path(target_path) as temporary_path, \
+            h5py.File(source_path, 'r') as source_file, h5py.File(temporary_path, 'w') as target_file:
+        source = source_file[PACKED_EMBEDDINGS_DATASET]
+        rows = source.shape[0]
+
+        target = target_file.create_dataset(PACKED_EMBEDDINGS_DATASET, shape=source.shape,
+                                            dtype=np.uint8 if encoding == INT8_ENCODING else np.dtype(encoding))
+        if encoding == INT8_ENCODING:
+            scales = target_file.create_dataset(PACKED_SCALES_DATASET, shape=(rows, 2), dtype=np.float32)
+
+        for block_start in range(0, rows, _PACKING_BLOCK_SIZE):
+            block_end = min(block_start + _PACKING_BLOCK_SIZE, rows)
+            encoded, block_scales = encode_block(source[block_start:block_end], encoding)
+            target[block_start:block_end] = encoded
+            if encoding == INT8_ENCODING:
+                scales[block_start:block_end] = block_scales
+
+        if dedup:
+            target_file.create_dataset(PACKED_LINE_IDS_DATASET,
+                                       data=np.asarray(source_file[PACKED_LINE_IDS_DATASET]))
+        target_file.create_dataset(PACKED_OFFSETS_DATASET, data=np.asarray(source_file[PACKED_OFFSETS_DATASET]))
+        target_file.create_dataset(PACKED_MISSING_DATASET, data=np.asarray(source_file[PACKED_MISSING_DATASET]))
+
+    print(f'Encoded packed embeddings of {set_name} as {encoding} in {target_path} '
+          f'({os.path.getsize(source_path) / 2 ** 20:.1f} MB -> {os.path.getsize(target_path) / 2 ** 20:.1f} MB)')
+
+    return target_path
+
+
+def export_memmap_embeddings(folder: str, set_name: str, encoding: str = FLOAT32_ENCODING,
+                             dedup: bool = False) -> str:
+    """
+    writes the packed embeddings of a set to a raw .npy matrix, which can be memory-mapped by all processes at once.
+    every file only appears once it is complete, the matrix after its scales, line ids and missing lines
+    """
+
+    source_path = packed_embeddings_file_path(folder, set_name, encoding, dedup)
+    target_path = memmap_embeddings_file_path(folder, set_name, encoding, dedup)
+
+    with h5py.File(source_path, 'r') as source_file:
+        companions = [(memmap_missing_lines_file_path(folder, set_name), PACKED_MISSING_DATASET)]
+        if encoding == INT8_ENCODING:
+            companions.append((memmap_scales_file_path(folder, set_name, encoding, dedup), PACKED_SCALES_DATASET))
+        if dedup:
+            companions.append((memmap_line_ids_file_path(folder, set_name), PACKED_LINE_IDS_DATASET))
+
+        for companion_path, dataset_name in companions:
+            with atomic_path(companion_path) as temporary_path:
+                np.save(temporary_path, np.asarray(source_file[dataset_name]))
+
+        source = source_file[PACKED_EMBEDDINGS_DATASET]
+        with atomic_path(target_path) as temporary_path:
+            target = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=source.dtype, shape=source.shape)
+
+            for block_start in range(0, source.shape[0], _PACKING_BLOCK_SIZE):
+                block_end = min(block_start + _PACKING_BLOCK_SIZE, source.shape[0])
+                target[block_start:block_end] = source[block_start:block_end]
+
+            target.flush()
+            del target
+
+    print(f'Exported packed embeddings of {set_name} to {target_path}')
+
+    return target_path
+
+
+def decode_rows(rows: np.ndarray, scales: np.ndarray = None, normalize: bool = False) -> np.ndarray:
+    """
+    decodes (float16 or int8) rows to float32, fused with the (x+6)/12 normalization into one affine
+    transformation per row
+    """
+
+    if scales is None:
+        if not normalize:
+            return rows.astype(np.float32, copy=False)
+        scale, offset = np.float32(1 / 12), np.float32(0.5)
+    else:
+        scale, offset = scales[:, 0:1], scales[:, 1:2]
+        if normalize:
+            scale, offset = scale / 12, (offset + 6) / 12
+
+    decoded = np.multiply(rows, scale, dtype=np.float32)
+    decoded += offset
+    return decoded
+
+
+def songs_without_missing_lines(start_indices: np.ndarray,
+                                numbers_of_lines: np.ndarray,
+                                missing_lines: np.ndarray) -> np.ndarray:
+    """
+    returns a boolean mask of the songs that do not contain any of the (sorted) missing lines
+    """
+
+    if len(missing_lines) == 0:
+        return np.ones(len(start_indices), dtype=np.bool_)
+
+    # first missing line at or after the start of every song
+    first_missing = np.searchsorted(missing_lines, start_indices, side='left')
+    first_missing_line = np.append(missing_lines, np.iinfo(np.int64).max)[first_missing]
+
+    return first_missing_line >= start_indices + numbers_of_lines
@@ -0,0 +1,117 @@
+import copy
+import math
+import queue
+from typing import List, Tuple
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+from utils.constants import *
+from utils.model_utils import save_models
+
+
+def _evaluation_loop(trainer, shared_model: torch.nn.Module, device: str, threads: int, stamp: str,
+                     requests, results):
+    """
+    evaluator process, scores every weight snapshot it is asked for with the _evaluate of a copy of the trainer
+    and saves model_best itself, so the training process never waits on validation or on pickling the weights
+    """
+
+    torch.set_num_threads(threads)
+    DATA_MANAGER.stamp = stamp
+
+    # on the cpu the snapshot is evaluated in place, it is only overwritten while this process is idle
+    trainer.model = shared_model if device == 'cpu' else copy.deepcopy(shared_model).to(device)
+    best_metrics = (math.inf, 0)
+
+    while True:
+        full = requests.get()
+        if full is None:
+            break
+
+        if trainer.model is not shared_model:
+            trainer.model.load_state_dict(shared_model.state_dict())
+
+        loss_validation, acc_validation = trainer._evaluate(full)
+
+        new_best = trainer.model.compare_metric(best_metrics, loss_validation, acc_validation)
+        if new_best:
+            save_models([trainer.model], 'model_best')
+            best_metrics = (loss_validation, acc_validation)
+
+        results.put((loss_validation, acc_validation, new_best))
+
+
+class AsyncEvaluator:
+    """
+    runs the validation of a trainer in a background process on snapshots of the model weights, which are copied into
+    shared memory whenever an evaluation is submitted. training continues on the cores that are not given to the
+    evaluator and picks up the (loss, accuracy, new best) results once they are ready
+    """
+
+    def __init__(self, trainer, device: str = "cpu", threads: int = 1):
+        self._shared_model = copy.deepcopy(trainer.model).cpu().share_memory()
+        self._busy = False
+
+        # spawn instead of fork, so the evaluator can also use cuda
+        context = multiprocessing.get_context('spawn')
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        # not a daemon, because the validation DataLoader may start worker processes of its own
+        self._process = context.Process(target=_evaluation_loop,
+                                        args=(trainer, self._shared_model, device, threads, DATA_MANAGER.stamp,
+                                              self._requests, self._results))
+        self._process.start()
+
+        torch.set_num_threads(max(1, torch.get_num_threads() - threads))
+
+    def submit(self, model: torch.nn.Module, full: bool, wait: bool = False) -> List[Tuple[float, float, bool]]:
+        """
+        snapshots the weights of the model and starts evaluating them. if the evaluator is still busy the snapshot
+        is skipped, unless wait is set. returns the results that came in meanwhile
+        """
+
+        results = self.results(wait=wait and self._busy)
+        if self._busy:
+            return results
+
+        with torch.no_grad():
+            for shared, current in zip(self._shared_model.state_dict().values(), model.state_dict().values()):
+                shared.copy_(current)
+
+        self._requests.put(full)
+        self._busy = True
+
+        return results
+
+    def results(self, wait: bool = False) -> List[Tuple[float, float, bool]]:
+        """
+        returns the result of the last evaluation if it finished (or, with wait, once it finishes)
+        """
+
+        if not self._busy:
+            return []
+
+        while True:
+            try:
+                result = self._results.get(timeout=1) if wait else self._results.get(block=False)
+                break
+            except queue.Empty:
+                if not wait:
+                    return []
+                if not self._process.is_alive():
+                    raise RuntimeError(f'Evaluator process stopped with exit code {self._process.exitcode}')
+
+        self._busy = False
+        return [result]
+
+    def close(self) -> List[Tuple[float, float, bool]]:
+        """
+        waits for the last evaluation and stops the evaluator process
+        """
+
+        results = self.results(wait=True) if self._process.is_alive() else []
+        self._requests.put(None)
+        self._process.join()
+
+        return results
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+
+class HDF5HandlePool:
+    """
+    keeps one open read-only handle per HDF5 file per process, so datasets don't reopen the file for every sample.
+    handles that were inherited through a fork (e.g. by DataLoader workers) are dropped and lazily reopened
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._handles = {}
+
+    def get(self, path: str) -> h5py.File:
+        """ returns the open handle of this process for path, opens it if needed """
+
+        if self._pid != os.getpid():
+            # HDF5 handles can't be shared between processes, forget the parent's handles without closing them
+            self._pid = os.getpid()
+            self._handles = {}
+
+        handle = self._handles.get(path)
+        if handle is None:
+            handle = h5py.File(path, 'r')
+            self._handles[path] = handle
+
+        return handle
+
+    def close(self):
+        """ closes all handles opened by this process """
+
+        if self._pid == os.getpid():
+            for handle in self._handles.values():
+                handle.close()
+        self._pid = os.getpid()
+        self._handles = {}
+
+
+HDF5_HANDLES = HDF5HandlePool()
+
+
+def get_hdf5_file(path: str) -> h5py.File:
+    """ returns the shared read-only handle of the current process/worker for an HDF5 file """
+
+    return HDF5_HANDLES.get(path)
+
+
+def close_hdf5_files():
+    """ closes all HDF5 handles of the current process/worker """
+
+    HDF5_HANDLES.close()
+
+
+def _benchmark_handle_pool(number_of_songs=2000, lines_per_song=40, embedding_size=256):
+    """ compares items/sec of the LyricsDataset with a file open per sample against the persistent handle """
+
+    from models.datasets.LyricsDataset import LyricsDataset
+    from models.entities.Song import Song
+    from models.enums.Genre import Genre
+    from utils.data_manager import DataManager
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(os.path.join(folder, 'embeddings'))
+
+        songs = []
+        for i in range(number_of_songs):
+            song = Song(Genre(i % len(Genre)), '\n'.join(['synthetic line'] * lines_per_song))
+            song.start_index = i * lines_per_song
+            songs.append(song)
+        DataManager(folder).save_python_obj(songs, 'song_lyrics.train', print_success=False)
+
+        with h5py.File(os.path.join(folder, 'embeddings', 'embeddings.train.hdf5'), 'w') as embeddings_file:
+            for line in range(number_of_songs * lines_per_song):
+                embeddings_file.create_dataset(str(line), data=np.random.randn(1, embedding_size).astype(np.float32))
+
+        dataset = LyricsDataset(folder, 'train')
+
+        for name, reopen in [('open per sample', True), ('persistent handle', False)]:
+            close_hdf5_files()
+            start = time.time()
+            for index in range(len(dataset)):
+                dataset[index]
+                if reopen:
+                    close_hdf5_files()
+            items_per_second = len(dataset) / (time.time() - start)
+            print(f'{name:>20s}: {items_per_second:10.1f} items/sec')
+
+        close_hdf5_files()
+
+
+if __name__ == '__main__':
+    from utils.system_utils import ensure_current_directory
+
+    ensure_current_directory()
+    _benchmark_handle_pool()
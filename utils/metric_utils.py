@@ -0,0 +1,88 @@
+import contextlib
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from utils.distributed_utils import all_reduce_mean
+
+
+def _normal_tensors():
+    """ allocates regular tensors even under inference mode, so they can still be updated in place after it """
+
+    return torch.inference_mode(False) if hasattr(torch, 'inference_mode') else contextlib.nullcontext()
+
+
+class MetricAccumulator:
+    """
+    accumulates named metrics per batch as tensors on the device they were computed on, so adding a batch never
+    waits for the device. the running sums are only read back, in one transfer, when they are flushed at a log or
+    evaluation boundary. with a capacity the values of every batch are also kept in a preallocated history.
+    distributed accumulators average the means and the history over all processes when they are read, which every
+    process has to do at the same point after adding the same number of batches
+    """
+
+    def __init__(self, names: List[str], capacity: int = 0, distributed: bool = False):
+        self.names = names
+        self.capacity = capacity
+        self.distributed = distributed
+        self._sums = None
+        self._history = None
+        self._count = 0
+
+    def reset(self):
+        """ starts new sums and a new history, the allocated tensors are reused """
+
+        if self._sums is not None:
+            self._sums.zero_()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, **values):
+        """ adds the (tensor or float) value of every metric of one batch """
+
+        if self._sums is None:
+            device = next((value.device for value in values.values() if torch.is_tensor(value)), 'cpu')
+            with _normal_tensors():
+                self._sums = torch.zeros(len(self.names), dtype=torch.float32, device=device)
+                if self.capacity > 0:
+                    self._history = torch.zeros((self.capacity, len(self.names)), dtype=torch.float32,
+                                                device=device)
+
+        row = torch.stack([torch.as_tensor(values[name]).detach().to(self._sums.device, torch.float32).reshape(())
+                           for name in self.names])
+        self._sums += row
+
+        if self._history is not None:
+            if self._count == len(self._history):
+                with _normal_tensors():
+                    self._history = torch.cat([self._history, torch.zeros_like(self._history)])
+            self._history[self._count] = row
+
+        self._count += 1
+
+    def means(self) -> Dict[str, float]:
+        """ the mean of every metric since the last reset """
+
+        if self._sums is None or self._count == 0:
+            return {name: 0.0 for name in self.names}
+
+        means = self._sums / self._count
+        if self.distributed:
+            means = all_reduce_mean(means)
+
+        return dict(zip(self.names, means.tolist()))
+
+    def history(self) -> np.ndarray:
+        """ the [batches, metrics] values of every batch since the last reset """
+
+        if self._history is None:
+            return np.zeros((0, len(self.names)), dtype=np.float32)
+
+        history = self._history[:self._count]
+        if self.distributed:
+            history = all_reduce_mean(history)
+
+        return history.cpu().numpy()
@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.optim as opt
 
 from utils.constants import *
+from utils.distributed_utils import is_main_process
 
 types = [CLASS_DIR, GEN_DIR, LOSS_DIR, DATASETS]
 models = {x: {} for x in types}
@@ -52,14 +53,23 @@ def delete_list(items):
 def save_models(models: List[nn.Module],
                 suffix: str):
     """
-    Saves current state of models
+    Saves current state of models, only in the first process of a distributed run
     """
 
+    if not is_main_process():
+        return
+
     save_dict = {str(model.__class__): model.state_dict() for model in models}
 
     DATA_MANAGER.save_python_obj(save_dict, os.path.join(RESULTS_DIR, DATA_MANAGER.stamp, MODELS_DIR, suffix), print_success=False)
 
 
+def inference_mode():
+    """ context without autograd for evaluation, inference mode where torch has it (>= 1.9) """
+
+    return torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+
+
 def calculate_accuracy(targets, output, *ignored):
     output = torch.nn.functional.softmax(output, dim=-1).detach()
     _, classifications = output.detach().max(dim=-1)
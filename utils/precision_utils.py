@@ -0,0 +1,116 @@
+import contextlib
+import time
+from typing import Iterable
+
+import torch
+from torch.optim.optimizer import Optimizer
+
+FLOAT32 = 'float32'
+AUTOCAST_DTYPES = [FLOAT32, 'bfloat16', 'float16']
+
+
+def autocast(device: str, dtype_name: str = FLOAT32):
+    """
+    mixed precision context of a forward pass and its loss, a no-op for float32. bfloat16 runs on the cpu and on cuda
+    (torch >= 1.10), float16 only on cuda
+    """
+
+    assert dtype_name in AUTOCAST_DTYPES, f'Unknown autocast dtype {dtype_name}'
+    if dtype_name == FLOAT32:
+        return contextlib.nullcontext()
+
+    device_type = 'cuda' if 'cuda' in str(device) else 'cpu'
+    assert device_type == 'cuda' or dtype_name != 'float16', 'float16 autocast needs cuda, use bfloat16 on the cpu'
+
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device_type, dtype=getattr(torch, dtype_name))
+
+    assert device_type == 'cuda' and dtype_name == 'float16', \
+        f'{dtype_name} autocast on {device_type} needs torch >= 1.10'
+    return torch.cuda.amp.autocast()
+
+
+class GradientAccumulator:
+    """
+    sums the gradients of accumulation_steps micro-batches before one optimizer step, so the effective batch is
+    accumulation_steps times larger. the losses are averaged over the micro-batches, also over the fewer ones of an
+    accumulation that is cut short, and with loss scaling (float16) the gradients are unscaled before they are
+    clipped, so max_norm applies to the real gradients
+    """
+
+    def __init__(self, optimizer: Optimizer, parameters: Iterable[torch.nn.Parameter], accumulation_steps: int = 1,
+                 max_norm: float = 5.0, loss_scaling: bool = False):
+        self.optimizer = optimizer
+        self.parameters = list(parameters)
+        self.accumulation_steps = accumulation_steps
+        self.max_norm = max_norm
+        # disabled, the scaler passes the loss and the optimizer step through unchanged
+        if hasattr(getattr(torch, 'amp', None), 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=loss_scaling)
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=loss_scaling)
+        self._micro_batches = 0
+
+    def will_step(self, last: bool = False) -> bool:
+        """ whether the optimizer steps after the backward of the next micro-batch """
+
+        return last or self._micro_batches + 1 >= self.accumulation_steps
+
+    def backward(self, loss: torch.Tensor, last: bool = False) -> bool:
+        """
+        adds the gradients of the loss of a micro-batch, and steps the optimizer after the last micro-batch of an
+        accumulation (or with last, e.g. at the end of an epoch). returns whether the optimizer stepped
+        """
+
+        step = self.will_step(last)
+
+        self.scaler.scale(loss / self.accumulation_steps).backward()
+        self._micro_batches += 1
+
+        if not step:
+            return False
+
+        # the losses were divided by accumulation_steps, an accumulation cut short by last has fewer micro-batches
+        if self._micro_batches < self.accumulation_steps:
+            for parameter in self.parameters:
+                if parameter.grad is not None:
+                    parameter.grad.mul_(self.accumulation_steps / self._micro_batches)
+
+        self.scaler.unscale_(self.optimizer)
+        torch.nn.utils.clip_grad_norm_(self.parameters, max_norm=self.max_norm)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad()
+        self._micro_batches = 0
+
+        return True
+
+
+def _benchmark_mixed_precision(batch_size=32, song_length=80, embedding_size=256, hidden_dim=256, iterations=20):
+    """ compares the training throughput of the LSTMClassifier in float32 and under bfloat16 autocast on the cpu """
+
+    from models.classifiers.LSTMClassifier import LSTMClassifier
+
+    torch.manual_seed(0)
+    batch = torch.randn(batch_size, song_length, embedding_size)
+    lengths = torch.arange(song_length, song_length - batch_size, -1).clamp(min=1)
+    targets = torch.randint(0, 5, (batch_size,))
+
+    for dtype_name, accumulation_steps in [(FLOAT32, 1), ('bfloat16', 1), (FLOAT32, 4), ('bfloat16', 4)]:
+        model = LSTMClassifier(num_classes=5, hidden_dim=hidden_dim, embedding_size=embedding_size)
+        gradients = GradientAccumulator(torch.optim.Adam(model.parameters()), model.parameters(), accumulation_steps)
+        loss_function = torch.nn.CrossEntropyLoss()
+
+        start = time.time()
+        for iteration in range(iterations):
+            with autocast('cpu', dtype_name):
+                loss = loss_function(model.forward(batch, lengths)[0], targets)
+            gradients.backward(loss, last=iteration + 1 == iterations)
+        elapsed = time.time() - start
+
+        print(f'{dtype_name:>8}, accumulation {accumulation_steps}: {iterations * batch_size / elapsed:8.1f} songs/sec '
+              f'({1000 * elapsed / iterations:.1f} ms per micro-batch, final loss {loss.item():.4f})')
+
+
+if __name__ == '__main__':
+    _benchmark_mixed_precision()
@@ -0,0 +1,164 @@
+import math
+from typing import List, Iterator
+
+import numpy as np
+from torch.utils.data import Sampler
+
+from utils.distributed_utils import get_world_size, get_rank
+
+
+class BucketBatchSampler(Sampler):
+    """
+    batch sampler that splits the dataset in buckets of items with similar lengths and draws every batch from a
+    single bucket, so batches need little padding. items are shuffled inside their bucket and batches across buckets
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, number_of_buckets: int = 10, shuffle: bool = True,
+                 drop_last: bool = False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+        order = np.argsort(self.lengths, kind='stable')
+        self.buckets = [bucket for bucket in np.array_split(order, min(number_of_buckets, len(order))) if len(bucket) > 0]
+
+    def _batches_of_bucket(self, bucket: np.ndarray) -> List[np.ndarray]:
+        batches = [bucket[start:start + self.batch_size] for start in range(0, len(bucket), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = np.random.permutation(bucket)
+            batches += self._batches_of_bucket(bucket)
+
+        if self.shuffle:
+            np.random.shuffle(batches)
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return sum([len(self._batches_of_bucket(bucket)) for bucket in self.buckets])
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    batch sampler that fills every batch with items of similar lengths up to a budget of padded tokens
+    (batch size times the longest item), so short items come in large batches and long items in small ones.
+    the budget bounds the batch tensors only if the collate function pads to the longest item of the batch
+    (PaddedBatchCollator, TokenBatchCollator) and the lengths are the padded lengths of the items
+    """
+
+    def __init__(self, lengths: np.ndarray, max_tokens_per_batch: int, shuffle: bool = True):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.shuffle = shuffle
+
+        # the batch boundaries only depend on the sorted lengths, so they are the same every epoch
+        self.batch_ends = self._batch_ends(np.sort(self.lengths, kind='stable'))
+
+    def _batch_ends(self, sorted_lengths: np.ndarray) -> List[int]:
+        """ greedily packs the sorted lengths, an item longer than the budget gets a batch of its own """
+
+        batch_ends = []
+        batch_start = 0
+        for end in range(1, len(sorted_lengths) + 1):
+            # lengths are sorted, so the last item of a batch is also the longest
+            if (end - batch_start) * sorted_lengths[end - 1] > self.max_tokens_per_batch and end - 1 > batch_start:
+                batch_ends.append(end - 1)
+                batch_start = end - 1
+        if batch_start < len(sorted_lengths):
+            batch_ends.append(len(sorted_lengths))
+
+        return batch_ends
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.shuffle:
+            # shuffle items of equal length among each other, without changing the batch boundaries
+            permutation = np.random.permutation(len(self.lengths))
+            order = permutation[np.argsort(self.lengths[permutation], kind='stable')]
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+
+        batches = np.split(order, self.batch_ends[:-1])
+
+        if self.shuffle:
+            np.random.shuffle(batches)
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return len(self.batch_ends)
+
+
+class StratifiedSubsetSampler(Sampler):
+    """
+    sampler over a fixed subset of number_of_items items with the same class proportions as the whole dataset,
+    so frequent validation checks on the subset stay comparable with each other
+    """
+
+    def __init__(self, labels: np.ndarray, number_of_items: int, seed: int = 0, num_replicas: int = 1, rank: int = 0):
+        labels = np.asarray(labels)
+        number_of_items = min(number_of_items, len(labels))
+        random_state = np.random.RandomState(seed)
+
+        classes, counts = np.unique(labels, return_counts=True)
+
+        # proportional share of every class, the items left after rounding down go to the largest remainders
+        shares = counts * number_of_items / max(len(labels), 1)
+        per_class = np.floor(shares).astype(np.int64)
+        remainders = np.argsort(per_class - shares, kind='stable')[:number_of_items - int(per_class.sum())]
+        per_class[remainders] += 1
+
+        indices = np.sort(np.concatenate(
+            [random_state.choice(np.flatnonzero(labels == label), size, replace=False)
+             for label, size in zip(classes, per_class)] + [np.zeros(0, dtype=np.int64)]))
+
+        # in a distributed run every process validates its own share, padded so all shares have the same size
+        self.indices = np.resize(indices, len(indices) + (-len(indices)) % num_replicas)[rank::num_replicas]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.indices.tolist())
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+
+class DistributedBatchSampler(Sampler):
+    """
+    shards the batches of a batch sampler over the processes of a distributed run. every process draws the batches
+    of an epoch with the same seed and takes every num_replicas-th one, repeating batches so that all processes
+    run the same number of steps
+    """
+
+    def __init__(self, batch_sampler: Sampler, num_replicas: int = None, rank: int = None, seed: int = 0):
+        self.batch_sampler = batch_sampler
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        # the batch samplers shuffle with the global numpy state, which differs between the processes
+        state = np.random.get_state()
+        np.random.seed(self.seed + self.epoch)
+        try:
+            batches = list(self.batch_sampler)
+        finally:
+            np.random.set_state(state)
+
+        batches = [batches[index % len(batches)] for index in range(len(self) * self.num_replicas)]
+
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.batch_sampler) / self.num_replicas)
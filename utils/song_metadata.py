@@ -0,0 +1,124 @@
+import os
+from typing import Iterable, List
+
+import numpy as np
+
+from utils.data_manager import DataManager
+from utils.system_utils import atomic_write
+
+
+def song_pickle_path(folder: str, set_name: str) -> str:
+    return os.path.join(folder, f'song_lyrics.{set_name}.pickle')
+
+
+def song_metadata_file_path(folder: str, set_name: str) -> str:
+    return os.path.join(folder, f'song_lyrics.{set_name}.metadata.npz')
+
+
+def song_lyrics_file_path(folder: str, set_name: str) -> str:
+    return os.path.join(folder, f'song_lyrics.{set_name}.lyrics.bin')
+
+
+class SongMetadata:
+    """
+    columnar metadata of the songs of a set: one array per field instead of a list of Song objects.
+    the lyrics live in a separate utf-8 blob that is only memory-mapped when a lyric is read
+    """
+
+    def __init__(self, lyrics_file_path: str, genre: np.ndarray, start_index: np.ndarray,
+                 number_of_lines: np.ndarray, number_of_words: np.ndarray,
+                 lyrics_start: np.ndarray, lyrics_end: np.ndarray):
+        self.lyrics_file_path = lyrics_file_path
+        self.genre = genre
+        self.start_index = start_index
+        self.number_of_lines = number_of_lines
+        self.number_of_words = number_of_words
+        self.lyrics_start = lyrics_start
+        self.lyrics_end = lyrics_end
+        self._lyrics_blob = None
+
+    def __getstate__(self):
+        # the memory-map is reopened in the worker instead of copied into it
+        state = self.__dict__.copy()
+        state['_lyrics_blob'] = None
+        return state
+
+    def __len__(self):
+        return len(self.genre)
+
+    def select(self, rows) -> 'SongMetadata':
+        """ returns the metadata of a subset of the songs, given as a boolean mask or indices """
+
+        return SongMetadata(self.lyrics_file_path, self.genre[rows], self.start_index[rows],
+                            self.number_of_lines[rows], self.number_of_words[rows],
+                            self.lyrics_start[rows], self.lyrics_end[rows])
+
+    def lyrics(self, index: int) -> str:
+        if self._lyrics_blob is None:
+            if os.path.getsize(self.lyrics_file_path) == 0:
+                return ''
+            self._lyrics_blob = np.memmap(self.lyrics_file_path, dtype=np.uint8, mode='r')
+
+        return self._lyrics_blob[self.lyrics_start[index]:self.lyrics_end[index]].tobytes().decode('utf-8')
+
+    def all_lyrics(self) -> List[str]:
+        return [self.lyrics(index) for index in range(len(self))]
+
+
+def write_song_metadata(folder: str, set_name: str, song_entries: Iterable):
+    """
+    converts Song objects to the metadata arrays and the lyrics blob of a set. the songs are read once, as they come,
+    so they can be streamed: only the metadata columns are kept in memory. both files only replace older versions once
+    they are complete, the metadata, which load_song_metadata checks for, after the lyrics
+    """
+
+    genre, start_index, number_of_lines, number_of_words, lyrics_offset = [], [], [], [], [0]
+
+    with atomic_write(song_lyrics_file_path(folder, set_name)) as lyrics_file:
+        for song_entry in song_entries:
+            lyrics = song_entry.lyrics.encode('utf-8')
+            lyrics_file.write(lyrics)
+
+            genre.append(song_entry.genre.value)
+            start_index.append(song_entry.start_index)
+            number_of_lines.append(song_entry.number_of_lines)
+            number_of_words.append(song_entry.number_of_words)
+            lyrics_offset.append(lyrics_offset[-1] + len(lyrics))
+
+    with atomic_write(song_metadata_file_path(folder, set_name)) as metadata_file:
+        np.savez(metadata_file,
+                 genre=np.asarray(genre, dtype=np.int8),
+                 start_index=np.asarray(start_index, dtype=np.int64),
+                 number_of_lines=np.asarray(number_of_lines, dtype=np.int64),
+                 number_of_words=np.asarray(number_of_words, dtype=np.int64),
+                 lyrics_offset=np.asarray(lyrics_offset, dtype=np.int64))
+
+
+def load_song_metadata(folder: str, set_name: str) -> SongMetadata:
+    """
+    loads the metadata of a set, converting the song_lyrics.{set} pickle first if the metadata is missing or older
+    """
+
+    metadata_path = song_metadata_file_path(folder, set_name)
+    lyrics_path = song_lyrics_file_path(folder, set_name)
+    pickle_path = song_pickle_path(folder, set_name)
+
+    has_metadata = os.path.exists(metadata_path) and os.path.exists(lyrics_path)
+    if not has_metadata and not os.path.exists(pickle_path):
+        raise FileNotFoundError(f'Songs of the {set_name} set not found: {metadata_path} with {lyrics_path} or '
+                                f'{pickle_path} is missing, run preprocessing/lyrics_preprocessing.py first')
+
+    if not has_metadata or \
+            (os.path.exists(pickle_path) and os.path.getmtime(pickle_path) > os.path.getmtime(metadata_path)):
+        print(f'Converting song_lyrics.{set_name} to columnar metadata')
+        write_song_metadata(folder, set_name, DataManager(folder).load_python_obj(f'song_lyrics.{set_name}'))
+
+    with np.load(metadata_path) as columns:
+        lyrics_offset = columns['lyrics_offset']
+        return SongMetadata(song_lyrics_file_path(folder, set_name),
+                            columns['genre'].astype(np.int64),
+                            columns['start_index'],
+                            columns['number_of_lines'],
+                            columns['number_of_words'],
+                            lyrics_offset[:-1],
+                            lyrics_offset[1:])
@@ -1,3 +1,6 @@
+import contextlib
+import tempfile
+
 from utils.constants import *
 
 
@@ -45,3 +48,61 @@ def save_codebase_of_run(arguments):
     for file_name in list(os.listdir(base)):
         if ("arguments.txt" in file_name): continue
         os.rename(base + "/" + file_name, base + "/" + file_name + ".py")
+
+
+@contextlib.contextmanager
+def atomic_path(file_path: str):
+    """
+    yields the path of a temporary file next to file_path (with the same extension), which replaces file_path once
+    the block completed, so concurrent runs (or processes of a distributed run) that find the file never read it
+    half-written and a crash never leaves a truncated file behind
+    """
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.',
+                                                       prefix=f'.{os.path.basename(file_path)}.',
+                                                       suffix=f'.tmp{os.path.splitext(file_path)[1]}')
+    os.close(file_descriptor)
+    try:
+        yield temporary_path
+        # mkstemp creates the file only readable by its owner, give it the permissions of a regularly created file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary_path, 0o666 & ~umask)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_write(file_path: str, mode: str = 'wb'):
+    """ opens a temporary file that replaces file_path once it is completely written, see atomic_path """
+
+    with atomic_path(file_path) as temporary_path:
+        with open(temporary_path, mode) as file:
+            yield file
+
+
+def get_resident_memory() -> dict:
+    """
+    returns the resident memory of the current process in MB, split in anonymous (private) memory
+    and file-backed memory, which memory-mapped files share with every other process that maps them
+    """
+
+    memory = {}
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith(('VmRSS', 'RssAnon', 'RssFile', 'RssShmem')):
+                    key, value = line.split(':')
+                    memory[key] = int(value.split()[0]) / 1024
+    except FileNotFoundError:
+        # no procfs, fall back on the peak resident memory (in KB on linux, bytes on mac, not available on windows)
+        try:
+            import resource
+            memory['VmRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        except ImportError:
+            pass
+
+    return memory
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import time
+from multiprocessing import Pool
+from typing import Dict, List
+
+import nltk
+import numpy as np
+from nltk.tokenize import word_tokenize
+
+from utils.data_manager import DataManager
+
+_TOKENIZATION_CHUNK_SIZE = 256
+
+# changing the tokenizer invalidates every cached sequence
+TOKENIZER_SETTINGS = f'nltk-{nltk.__version__}-word_tokenize'
+
+
+def _tokenize_chunk(lyrics: List[str]) -> List[List[str]]:
+    """ tokenization task, returns the words of every lyrics in the chunk """
+
+    return [word_tokenize(song_lyrics) for song_lyrics in lyrics]
+
+
+def tokenize_lyrics(lyrics: List[str], processes: int = None,
+                    chunk_size: int = _TOKENIZATION_CHUNK_SIZE) -> List[List[str]]:
+    """
+    tokenizes the lyrics of many songs in chunks on a process pool, keeping their order,
+    and reports the progress and throughput
+    """
+
+    chunks = [lyrics[start:start + chunk_size] for start in range(0, len(lyrics), chunk_size)]
+
+    start_time = time.time()
+    tokenized, number_of_tokens = [], 0
+
+    def report(end='\r'):
+        elapsed = max(time.time() - start_time, 1e-9)
+        print(f'Tokenized {len(tokenized)}/{len(lyrics)} songs: {len(tokenized) / elapsed:.1f} songs/sec, '
+              f'{number_of_tokens / elapsed:.1f} tokens/sec       ', end=end)
+
+    if processes == 1 or len(chunks) <= 1:
+        results = map(_tokenize_chunk, chunks)
+        pool = None
+    else:
+        pool = Pool(processes)
+        results = pool.imap(_tokenize_chunk, chunks)
+
+    try:
+        for chunk in results:
+            tokenized.extend(chunk)
+            number_of_tokens += sum(len(words) for words in chunk)
+            report()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report(end='\n')
+
+    return tokenized
+
+
+def encode_words(words: List[str], w2i: Dict[str, int]) -> np.ndarray:
+    """ returns the int32 vocabulary ids of the words, unknown words become <unk> """
+
+    return np.asarray([w2i.get(word, w2i['<unk>']) for word in words], dtype=np.int32)
+
+
+class TokenizationCache:
+    """
+    on-disk cache of the token ids of song lyrics, keyed by a hash of the lyrics and the tokenizer settings.
+    the ids are stored untruncated, so they are shared by all sets, genres and max sequence lengths,
+    and the whole cache is dropped when the vocabulary file changes
+    """
+
+    def __init__(self, folder: str, vocab_file: str, cache_name: str = 'lyrics.tokens_cache'):
+        self.data_manager = DataManager(folder)
+        self.cache_name = cache_name
+        with open(os.path.join(folder, vocab_file), 'rb') as file:
+            self.vocab_fingerprint = hashlib.sha1(file.read()).hexdigest()
+
+        self.sequences = {}
+        if os.path.exists(os.path.join(folder, f'{cache_name}.pickle')):
+            cache = self.data_manager.load_python_obj(cache_name)
+            if cache['vocab_fingerprint'] == self.vocab_fingerprint:
+                self.sequences = cache['sequences']
+            else:
+                print('Vocabulary changed, dropping the tokenization cache')
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(lyrics: str) -> bytes:
+        return hashlib.sha1(f'{TOKENIZER_SETTINGS}\0{lyrics}'.encode('utf-8')).digest()
+
+    def put(self, lyrics: List[str], tokenized_songs: List[List[str]], w2i: Dict[str, int]):
+        """ adds already tokenized songs to the cache and saves it """
+
+        for song_lyrics, words in zip(lyrics, tokenized_songs):
+            self.sequences[self.key(song_lyrics)] = encode_words(words, w2i)
+        self.save()
+
+    def encode(self, lyrics: List[str], w2i: Dict[str, int], processes: int = None) -> List[np.ndarray]:
+        """ returns the token ids of every lyrics, only the songs that aren't cached yet are tokenized """
+
+        keys = [self.key(song_lyrics) for song_lyrics in lyrics]
+        missing = [i for i, key in enumerate(keys) if key not in self.sequences]
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            tokenized_songs = tokenize_lyrics([lyrics[i] for i in missing], processes)
+            for i, words in zip(missing, tokenized_songs):
+                self.sequences[keys[i]] = encode_words(words, w2i)
+            self.save()
+
+        print(f'Tokenization cache: {len(keys) - len(missing)}/{len(keys)} songs cached '
+              f'(hit rate {self.hit_rate():.3f} over {self.hits + self.misses} lookups)')
+
+        return [self.sequences[key] for key in keys]
+
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def save(self):
+        self.data_manager.save_python_obj({'vocab_fingerprint': self.vocab_fingerprint,
+                                           'tokenizer': TOKENIZER_SETTINGS,
+                                           'sequences': self.sequences}, self.cache_name, print_success=False)